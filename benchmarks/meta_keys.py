@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    Time Meta.keys(), MetaKey truthiness and len() on a large Metas,
+    comparing opencollab.meta against the 1.1.0 classes.
+
+    usage: python benchmarks/meta_keys.py [pages] [keys] [values]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import legacymeta  # noqa: E402
+import opencollab.meta  # noqa: E402
+
+
+def build(module, pages, keys, values):
+    metas = module.Metas()
+    for page in xrange(pages):
+        meta = metas[u"Page %d" % page]
+        for key in xrange(keys):
+            meta[u"key %d" % key].update(u"value %d" % value
+                                         for value in xrange(values))
+    return metas
+
+
+def run(metas):
+    total = 0
+    for page in metas.keys():
+        meta = metas[page]
+        for key in meta.keys():
+            if key in meta:
+                total += len(meta[key])
+    return total
+
+
+def measure(name, module, pages, keys, values, rounds=3):
+    metas = build(module, pages, keys, values)
+
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        total = run(metas)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print "%-10s %8.3f s (%d values)" % (name, best, total)
+    return best
+
+
+def main():
+    args = map(int, sys.argv[1:])
+    pages, keys, values = args + [10000, 20, 10][len(args):]
+
+    print "%d pages, %d keys per page, %d values per key" % (pages, keys, values)
+    legacy = measure("legacy", legacymeta, pages, keys, values)
+    current = measure("current", opencollab.meta, pages, keys, values)
+    print "speedup %.1fx" % (legacy / max(current, 1e-9))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+    Compare the memory use of opencollab.meta against the 1.1.0
+    classes on a synthetic getMeta-like result. Each implementation
+    is measured in a forked child process.
+
+    usage: python benchmarks/meta_memory.py [pages] [keys] [values]
+"""
+import os
+import sys
+import time
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import legacymeta  # noqa: E402
+import opencollab.meta  # noqa: E402
+
+
+def rss():
+    statm = open("/proc/self/statm")
+    try:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+    finally:
+        statm.close()
+
+
+def build(module, pages, keys, values):
+    metas = dict()
+
+    for page in xrange(pages):
+        meta = module.Meta()
+        for key in xrange(keys):
+            # A new key object for every page, as with most parsers
+            name = u"key %d" % key
+            meta[name].update(u"value %d" % value for value in xrange(values))
+
+        # Lookups of keys that the page does not have
+        for key in xrange(keys, keys + 5):
+            list(meta[u"key %d" % key])
+
+        metas[u"Page %d" % page] = meta
+
+    return metas
+
+
+def measure(name, module, pages, keys, values):
+    read, write = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        before = rss()
+        start = time.time()
+        metas = build(module, pages, keys, values)
+        elapsed = time.time() - start
+        used = rss() - before
+        assert len(metas) == pages
+        os.write(write, "%d %f" % (used, elapsed))
+        os._exit(0)
+
+    os.close(write)
+    result = os.read(read, 1024)
+    os.close(read)
+    os.waitpid(pid, 0)
+
+    used, elapsed = result.split()
+    used = int(used)
+    elapsed = float(elapsed)
+    print "%-10s %8.1f MiB %8.2f s" % (name, used / 1024.0 / 1024.0, elapsed)
+    return used
+
+
+def main():
+    args = map(int, sys.argv[1:])
+    pages, keys, values = args + [100000, 20, 2][len(args):]
+
+    print "%d pages, %d keys per page, %d values per key" % (pages, keys, values)
+    legacy = measure("legacy", legacymeta, pages, keys, values)
+    current = measure("current", opencollab.meta, pages, keys, values)
+    print "current uses %.0f%% of legacy" % (100.0 * current / max(legacy, 1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+    An in-process stand-in for an IMAP4 server, enough for imaplib to
+    log in, select the inbox, search for UNSEEN messages and fetch
+    them (RFC822 and RFC822.SIZE) by message sets. Fetching RFC822
+    marks the messages seen. The messages are kept in memory, and
+    every command is delayed by the configured latency (seconds).
+
+    >>> server = MockIMAP(["Subject: a\\r\\n\\r\\nA", "Subject: b\\r\\n\\r\\nB"])
+    >>> server.start().url
+    '127.0.0.1:...'
+    >>> from opencollab.util.emailutils import imapAuth, fetchMessages
+    >>> mailbox = imapAuth(server.url, "user", "pass", ssl=False)
+    >>> list(fetchMessages(mailbox))
+    ['Subject: a\\r\\n\\r\\nA', 'Subject: b\\r\\n\\r\\nB']
+    >>> list(fetchMessages(mailbox))
+    []
+    >>> server.commands["FETCH"]
+    1
+    >>> server.stop()
+"""
+import re
+import time
+import threading
+import collections
+import SocketServer
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line + "\r\n")
+
+    def handle(self):
+        self.send("* OK mock IMAP4rev1 ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            tag, _, rest = line.strip().partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            self.server._count(command)
+
+            handler = getattr(self, "do_" + command, None)
+            if handler is None:
+                self.send("%s BAD unknown command" % tag)
+                continue
+            if handler(args) is False:
+                self.send("%s BAD invalid arguments" % tag)
+                continue
+            self.send("%s OK %s completed" % (tag, command))
+            if command == "LOGOUT":
+                return
+
+    def do_CAPABILITY(self, args):
+        self.send("* CAPABILITY IMAP4rev1")
+
+    def do_LOGIN(self, args):
+        pass
+
+    def do_LOGOUT(self, args):
+        self.send("* BYE")
+
+    def do_NOOP(self, args):
+        pass
+
+    def do_SELECT(self, args):
+        self.send("* %d EXISTS" % len(self.server.messages))
+        self.send("* 0 RECENT")
+
+    def do_SEARCH(self, args):
+        if "UNSEEN" not in args.upper():
+            return False
+        with self.server.lock:
+            nums = [str(num) for num in range(1, len(self.server.messages) + 1)
+                    if num not in self.server.seen]
+        self.send("* SEARCH " + " ".join(nums))
+
+    def do_FETCH(self, args):
+        match = re.match(r"^(\S+) \(?([^)]*)\)?$", args)
+        if match is None:
+            return False
+        nums, items = match.groups()
+        items = items.upper().split()
+
+        for num in self.server._numbers(nums):
+            data = self.server.messages[num - 1]
+            if "RFC822" in items:
+                with self.server.lock:
+                    self.server.seen.add(num)
+                self.wfile.write("* %d FETCH (RFC822 {%d}\r\n" % (num, len(data)))
+                self.wfile.write(data)
+                self.send(")")
+            elif "RFC822.SIZE" in items:
+                self.send("* %d FETCH (RFC822.SIZE %d)" % (num, len(data)))
+            else:
+                return False
+
+
+class MockIMAP(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages=(), latency=0.0):
+        SocketServer.TCPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.messages = list(messages)
+        self.latency = latency
+        self.seen = set()
+        self.commands = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return "%s:%d" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _count(self, command):
+        with self.lock:
+            self.commands[command] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _numbers(self, nums):
+        for part in nums.split(","):
+            first, _, last = part.partition(":")
+            if last == "*":
+                last = len(self.messages)
+            for num in range(int(first), int(last or first) + 1):
+                yield num
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+    An in-process stand-in for the GraphingWiki XML-RPC interface,
+    for benchmarking opencollab without a live collab. Pages, metas,
+    attachments and page cache files are kept in memory.
+
+    Every HTTP request is delayed by the configured latency (seconds)
+    plus the time its request and response bodies take to transfer at
+    the configured bandwidth (bytes per second), as sent on the wire.
+
+    >>> wiki = MockWiki().start()
+    >>> from opencollab.wiki import GraphingWiki
+    >>> collab = GraphingWiki(wiki.url)
+    >>> collab.authenticate("user", "pass")
+    True
+    >>> collab.putPage("Page", "content")
+    True
+    >>> wiki.calls["putPage"]
+    1
+    >>> wiki.stop()
+"""
+import time
+import hashlib
+import threading
+import xmlrpclib
+import collections
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+TOKEN = "mock-token"
+
+
+class _Handler(SimpleXMLRPCRequestHandler):
+    # The wiki is reached through any path, e.g. /collab/?action=...
+    rpc_paths = ()
+
+    def decode_request_content(self, data):
+        self._received = len(data)
+        return SimpleXMLRPCRequestHandler.decode_request_content(self, data)
+
+    def send_header(self, keyword, value):
+        # The response body, compressed or not, is ready by the time
+        # its length is sent.
+        if keyword.lower() == "content-length":
+            self.server._delay(getattr(self, "_received", 0) + int(value))
+        SimpleXMLRPCRequestHandler.send_header(self, keyword, value)
+
+
+class MockWiki(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, bandwidth=None):
+        SimpleXMLRPCServer.__init__(self, ("127.0.0.1", 0), _Handler,
+                                    logRequests=False, allow_none=True)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        self.pages = dict()
+        self.metas = dict()
+        self.attachments = dict()
+        self.cache = dict()
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.register_multicall_functions()
+        for name in ("getAuthToken", "applyAuthToken", "getPage", "putPage",
+                     "GetMeta", "SetMeta", "IncSetMeta", "AttachFile",
+                     "PageCache", "ChunkedAttachFile"):
+            self.register_function(self._counted(name), name)
+
+    @property
+    def url(self):
+        return "http://%s:%d/collab/" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _delay(self, size):
+        delay = self.latency
+        if self.bandwidth:
+            delay += size / float(self.bandwidth)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _counted(self, name):
+        func = getattr(self, name)
+
+        def counted(*args):
+            with self.lock:
+                self.calls[name] += 1
+                return func(*args)
+        return counted
+
+    def getAuthToken(self, username, password):
+        if username and password:
+            return TOKEN
+        return ""
+
+    def applyAuthToken(self, token):
+        if token != TOKEN:
+            raise xmlrpclib.Fault("INVALID", "invalid token")
+        return "SUCCESS"
+
+    def getPage(self, page):
+        return self.pages[page]
+
+    def putPage(self, page, content):
+        self.pages[page] = content
+        return True
+
+    def _search(self, search):
+        # Comma separated page names, or a category name
+        pages = list()
+        for term in search.split(","):
+            term = term.strip()
+            if term in self.metas:
+                pages.append(term)
+                continue
+            pages.extend(sorted(page for page, meta in self.metas.iteritems()
+                                if term in meta.get("gwikicategory", ())))
+        return pages
+
+    def GetMeta(self, search, keysOnly):
+        pages = self._search(search)
+        keys = sorted(set(key for page in pages for key in self.metas[page]))
+        rows = [keys]
+        for page in pages:
+            meta = self.metas[page]
+            rows.append([page] + [sorted(meta.get(key, ())) for key in keys])
+        return rows
+
+    def SetMeta(self, page, keys, metaMode, x, categoryMode, categories,
+                template):
+        meta = self.metas.setdefault(page, dict())
+        for key, values in keys.iteritems():
+            if metaMode == "repl":
+                meta[key] = set(values)
+            else:
+                meta.setdefault(key, set()).update(values)
+        if categoryMode == "set":
+            meta["gwikicategory"] = set(categories)
+        else:
+            meta.setdefault("gwikicategory", set()).update(categories)
+        return True
+
+    def IncSetMeta(self, cleared, discarded, added):
+        for page, keys in cleared.iteritems():
+            for key in keys:
+                self.metas.get(page, {}).pop(key, None)
+        for page, meta in discarded.iteritems():
+            for key, values in meta.iteritems():
+                self.metas.get(page, {}).get(key, set()).difference_update(values)
+        for page, meta in added.iteritems():
+            for key, values in meta.iteritems():
+                self.metas.setdefault(page, {}).setdefault(key, set()).update(values)
+        return True
+
+    def _files(self, files, page, filename, action, data):
+        if action == "save":
+            files[(page, filename)] = data.data
+            return True
+        if action == "load":
+            return xmlrpclib.Binary(files[(page, filename)])
+        if action == "delete":
+            return files.pop((page, filename), None) is not None
+        if action == "list":
+            return sorted(name for (other, name) in files if other == page)
+        raise xmlrpclib.Fault(1, "unknown action %r" % action)
+
+    def AttachFile(self, page, filename, action, data, overwrite, log=True):
+        return self._files(self.attachments, page, filename, action, data)
+
+    def PageCache(self, page, filename, action, data, overwrite):
+        return self._files(self.cache, page, filename, action, data)
+
+    def ChunkedAttachFile(self, page, filename, action, *args):
+        if action == "reassembly":
+            chunkSize, digests = args
+            missing = sorted(set(digest for digest in digests
+                                 if (page, digest) not in self.cache))
+            if not missing:
+                data = "".join(self.cache[(page, digest)]
+                               for digest in digests)
+                self.attachments[(page, filename)] = data
+            return missing
+        if action == "info":
+            data = self.attachments[(page, filename)]
+            return [hashlib.md5(data).hexdigest(), len(data)]
+        if action == "load":
+            start, end = args
+            data = self.attachments[(page, filename)]
+            return xmlrpclib.Binary(data[start:end])
+        raise xmlrpclib.Fault(1, "unknown action %r" % action)
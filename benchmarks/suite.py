@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+    Run the opencollab benchmarks against an in-process mock wiki (see
+    mockwiki.py) and print the results as JSON, one entry per
+    benchmark with the best time of the rounds and the resulting rate.
+    Given the results of an earlier run with --compare, benchmarks
+    that got slower by more than the threshold are reported and the
+    exit status is 1.
+
+    usage: python benchmarks/suite.py [options] [benchmark ...]
+"""
+import os
+import sys
+import imp
+import json
+import time
+import shutil
+import random
+import platform
+import optparse
+import tempfile
+import cStringIO
+import collections
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from mockwiki import MockWiki  # noqa: E402
+from mockimap import MockIMAP  # noqa: E402
+from opencollab.meta import Metas  # noqa: E402
+from opencollab.wiki import GraphingWiki  # noqa: E402
+from opencollab.util.charset import CharsetResolver  # noqa: E402
+from opencollab.util.emailutils import imapAuth, readMessages, htmlText  # noqa: E402
+
+SCRIPTS = os.path.join(os.path.dirname(__file__), "..", "scripts")
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(unit):
+    # Registers a function that prepares a benchmark. It returns the
+    # amount of work done per round, in the given unit, and a function
+    # doing one round. A third, optional, item resets the state
+    # between rounds outside of the timing.
+    def register(func):
+        BENCHMARKS[func.__name__] = func, unit
+        return func
+    return register
+
+
+def script(name):
+    return imp.load_source(name.replace("-", "_"), os.path.join(SCRIPTS, name))
+
+
+def buildMetas(pages, keys=10, values=3):
+    metas = Metas()
+    for page in xrange(pages):
+        meta = metas[u"Page %d" % page]
+        for key in xrange(keys):
+            meta[u"key %d" % key].update(u"value %d of k\xe4y %d" % (value, key)
+                                         for value in xrange(values))
+        meta["gwikicategory"].add(u"CategoryBench")
+    return metas
+
+
+@benchmark("pages")
+def meta_construction(env):
+    pages = env.scale(20000)
+    return pages, lambda: buildMetas(pages)
+
+
+@benchmark("pages")
+def getmeta_parse(env):
+    pages = env.scale(5000)
+    env.store(buildMetas(pages))
+    return pages, lambda: env.collab.getMeta(u"CategoryBench")
+
+
+@benchmark("pages")
+def itermeta_parse(env):
+    pages = env.scale(5000)
+    env.store(buildMetas(pages))
+    return pages, lambda: list(env.collab.iterMeta(u"CategoryBench"))
+
+
+@benchmark("pages")
+def incsetmeta(env):
+    pages = env.scale(5000)
+    metas = buildMetas(pages)
+
+    def run():
+        env.collab.incSetMeta(Metas(), Metas(), metas, maxPages=500)
+    return pages, run, env.wiki.metas.clear
+
+
+@benchmark("bytes")
+def put_attachment_chunked(env):
+    data = os.urandom(env.scale(16 * 1024 * 1024))
+
+    def run():
+        stream = cStringIO.StringIO(data)
+        for _ in env.collab.putAttachmentChunked(u"Page", u"file.bin", stream,
+                                                 chunksPerCheck=None,
+                                                 workers=env.workers):
+            pass
+    return len(data), run, env.wiki.cache.clear
+
+
+@benchmark("bytes")
+def get_attachment_chunked(env):
+    data = os.urandom(env.scale(16 * 1024 * 1024))
+    env.wiki.attachments[(u"Page", u"file.bin")] = data
+
+    def run():
+        for _ in env.collab.getAttachmentChunked(u"Page", u"file.bin"):
+            pass
+    return len(data), run
+
+
+def nmapXml(hosts):
+    out = ['<?xml version="1.0"?>\n<nmaprun scanner="nmap" args="nmap -A" ' +
+           'start="1234567890" version="5.00" xmloutputversion="1.03">\n']
+    for host in xrange(hosts):
+        out.append('<host><status state="up"/>' +
+                   '<address addr="10.%d.%d.%d" addrtype="ipv4"/>' %
+                   (host >> 16, (host >> 8) & 255, host & 255) +
+                   '<hostnames><hostname name="host%d.example" ' % host +
+                   'type="PTR"/></hostnames><ports>')
+        for port in (22, 80, 443):
+            out.append('<port protocol="tcp" portid="%d">' % port +
+                       '<state state="open"/><service name="svc" ' +
+                       'product="Product" version="1.0" extrainfo="x"/>' +
+                       '<script id="banner" output="banner text"/></port>')
+        out.append('</ports><os><osclass type="general purpose" ' +
+                   'vendor="Linux" osfamily="Linux" osgen="2.6.X" ' +
+                   'accuracy="100"/></os></host>\n')
+    out.append('<runstats><finished time="1234569999"/>' +
+               '<hosts up="%d" down="0" total="%d"/></runstats>' %
+               (hosts, hosts) + '</nmaprun>\n')
+    return "".join(out)
+
+
+def nessusXml(hosts, items=20):
+    rand = random.Random(1)
+    out = ['<?xml version="1.0" ?>\n<NessusClientData_v2>\n<Report name="r">\n']
+    for host in xrange(hosts):
+        out.append('<ReportHost name="10.%d.%d.%d"><HostProperties>' %
+                   (host >> 16, (host >> 8) & 255, host & 255) +
+                   '<tag name="HOST_START">Tue Mar  2 09:00:00 2010</tag>' +
+                   '<tag name="HOST_END">Tue Mar  2 10:00:00 2010</tag>' +
+                   '<tag name="operating-system">Linux Kernel 2.6</tag>' +
+                   '<tag name="fqdn">host%d.example</tag>' % host +
+                   '</HostProperties>\n')
+        for _ in xrange(items):
+            out.append('<ReportItem port="%d" svc_name="www" protocol="tcp" ' %
+                       rand.choice([0, 22, 80, 443]) +
+                       'severity="%d" pluginID="%d" pluginName="p">' %
+                       (rand.randint(0, 3), rand.randint(10000, 60000)) +
+                       '<description>Description CVE-2009-0001</description>' +
+                       '<synopsis>Synopsis</synopsis>' +
+                       '<plugin_output>Output text</plugin_output>' +
+                       '</ReportItem>\n')
+        out.append('</ReportHost>\n')
+    out.append('</Report>\n</NessusClientData_v2>\n')
+    return "".join(out)
+
+
+@benchmark("hosts")
+def nmap_parse(env):
+    hosts = env.scale(5000)
+    path = env.write("scan.xml", nmapXml(hosts))
+    module = script("opencollab-nmap-uploader")
+    return hosts, lambda: list(module.parse_xml(path, u"Run"))
+
+
+@benchmark("hosts")
+def nessus_parse(env):
+    hosts = env.scale(1000)
+    path = env.write("scan.nessus", nessusXml(hosts))
+    module = script("opencollab-nessus-uploader")
+    severities = module.SEVERITY_MAPPING.values()
+    return hosts, lambda: list(module.parse_nessus(path, u"Run",
+                                                   severities, None))
+
+
+def spamMessage(number, rand):
+    words = ["cheap", "pills", "offer", "winner", "prize", "money", "free"]
+    text = " ".join(rand.choice(words) for _ in xrange(300))
+    text += " http://spam%d.example.com/buy?id=%d" % (rand.randint(0, 50), number)
+
+    msg = MIMEMultipart()
+    msg.attach(MIMEText(text, "plain"))
+    msg.attach(MIMEText("<html><body><p>%s</p></body></html>" % text, "html"))
+    if number % 2:
+        part = MIMEApplication(os.urandom(rand.randint(1024, 64 * 1024)))
+        part.add_header("Content-Disposition", "attachment",
+                        filename="invoice%d.zip" % number)
+        msg.attach(part)
+    msg["From"] = "Spammer <spam%d@example.com>" % number
+    msg["To"] = "victim@example.org"
+    msg["Subject"] = "Offer %d" % number
+    msg["Date"] = "Mon, 1 Mar 2010 10:00:00 +0200"
+    msg["Return-Path"] = "<bounce%d@example.com>" % number
+    msg["Message-ID"] = "<%d.spam@example.com>" % number
+    return msg.as_string()
+
+
+@benchmark("messages")
+def spam_ingest(env):
+    rand = random.Random(1)
+    count = env.scale(500)
+    imap = env.imap([spamMessage(number, rand) for number in xrange(count)])
+
+    def run():
+        mailbox = imapAuth(imap.url, "bench", "bench", ssl=False)
+        for _ in readMessages(mailbox, env.collab, workers=env.workers):
+            pass
+        mailbox.logout()
+
+    def reset():
+        imap.seen.clear()
+        env.wiki.attachments.clear()
+        env.wiki.cache.clear()
+    return count, run, reset
+
+
+def spamHtml(rows, rand):
+    # A table-heavy HTML body with scripts, styles and hidden comments
+    parts = ["<html><head><style>td { color: #fff }</style></head>",
+             "<body><table>"]
+    for row in xrange(rows):
+        parts.append("<tr>%s</tr>\n" % "".join(
+            "<td class=c%d>cheap &amp; free %d</td>" % (cell, rand.randint(0, 99))
+            for cell in xrange(5)))
+        if row % 500 == 0:
+            parts.append("<script>%s</script>" %
+                         ("if (a<b) { c = '<b>'; }\n" * rand.randint(1, 2000)))
+            parts.append("<!-- %s -->" % ("hidden " * rand.randint(1, 5000)))
+    parts.append("</table></body></html>")
+    return "".join(parts)
+
+
+@benchmark("bytes")
+def html_text(env):
+    html = spamHtml(env.scale(10000), random.Random(1))
+    return len(html), lambda: htmlText(html)
+
+
+# Spam texts and the charsets they are sent in, without declaring any
+SPAM_TEXTS = [
+    (u"Cheap watches and pills, buy now from our store.", ["utf-8"]),
+    (u"Montres de qualit\xe9 \xe0 prix r\xe9duit, livraison tr\xe8s rapide.",
+     ["utf-8", "windows-1252"]),
+    (u"\u0414\u0435\u0448\u0435\u0432\u044b\u0435 \u0447\u0430\u0441\u044b "
+     u"\u0438 \u0442\u0430\u0431\u043b\u0435\u0442\u043a\u0438, "
+     u"\u043a\u0443\u043f\u0438\u0442\u0435 \u0441\u0435\u0439\u0447\u0430\u0441.",
+     ["utf-8", "windows-1251", "koi8-r"]),
+    (u"\u4fbf\u5b9c\u7684\u624b\u8868\u548c\u836f\u54c1\uff0c"
+     u"\u73b0\u5728\u5c31\u8d2d\u4e70\u3002", ["utf-8", "gbk"]),
+    (u"\uc800\ub834\ud55c \uc2dc\uacc4\uc640 \uc57d\ud488\uc744 "
+     u"\uc9c0\uae08 \uad6c\ub9e4\ud558\uc138\uc694.", ["utf-8", "euc-kr"]),
+    (u"\u5b89\u3044\u6642\u8a08\u3068\u85ac\u3092\u4eca\u3059\u3050"
+     u"\u8cfc\u5165\u3057\u3066\u304f\u3060\u3055\u3044\u3002",
+     ["utf-8", "shift_jis"]),
+]
+
+
+@benchmark("parts")
+def charset_detect(env):
+    rand = random.Random(1)
+    parts = list()
+    for number in xrange(env.scale(2000)):
+        text, charsets = rand.choice(SPAM_TEXTS)
+        html = u"<html><body>%s</body></html>" % u"\n".join(
+            u"<p>%s</p>" % text for _ in xrange(rand.randint(5, 200)))
+        domain = "spam%d.example.com" % rand.randint(0, 100)
+        parts.append((html.encode(rand.choice(charsets)), domain))
+
+    def run():
+        resolver = CharsetResolver()
+        for payload, domain in parts:
+            resolver.decode(payload, None, domain)
+    return len(parts), run
+
+
+class Environment(object):
+    # A fresh mock wiki, client and scratch directory per benchmark
+
+    def __init__(self, options):
+        self.options = options
+        self.workers = options.workers
+        self.wiki = MockWiki(options.latency, options.bandwidth).start()
+        self.collab = GraphingWiki(self.wiki.url, connections=options.workers)
+        self.collab.authenticate("bench", "bench")
+        self.directory = tempfile.mkdtemp(prefix="opencollab-bench-")
+        self.servers = [self.wiki]
+
+    def imap(self, messages):
+        server = MockIMAP(messages, self.options.latency).start()
+        self.servers.append(server)
+        return server
+
+    def scale(self, amount):
+        return max(1, int(amount * self.options.scale))
+
+    def store(self, metas):
+        for page, meta in metas.iteritems():
+            self.wiki.metas[page] = dict((key, set(values))
+                                         for key, values in meta.iteritems())
+
+    def write(self, name, data):
+        path = os.path.join(self.directory, name)
+        output = open(path, "wb")
+        try:
+            output.write(data)
+        finally:
+            output.close()
+        return path
+
+    def close(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def measure(name, options):
+    func, unit = BENCHMARKS[name]
+    env = Environment(options)
+    try:
+        prepared = func(env)
+        amount, run = prepared[:2]
+        reset = prepared[2] if len(prepared) > 2 else None
+
+        best = None
+        for _ in xrange(options.rounds):
+            if reset is not None:
+                reset()
+            before = sum(env.wiki.calls.values())
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+                calls = sum(env.wiki.calls.values()) - before
+    finally:
+        env.close()
+
+    result = collections.OrderedDict()
+    result["seconds"] = round(best, 6)
+    result["amount"] = amount
+    result["unit"] = unit
+    result["rate"] = round(amount / max(best, 1e-9), 3)
+    result["calls"] = calls
+    return result
+
+
+def compare(results, baseline, threshold):
+    regressions = list()
+    for name, result in results.iteritems():
+        old = baseline.get("results", {}).get(name, None)
+        if old is None or old.get("amount") != result["amount"]:
+            continue
+        ratio = result["seconds"] / max(old["seconds"], 1e-9)
+        status = "ok"
+        if ratio > 1.0 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        print >> sys.stderr, "%-24s %9.3f s -> %9.3f s %6.2fx %s" % \
+            (name, old["seconds"], result["seconds"], ratio, status)
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.set_usage("%prog [options] [benchmark ...]")
+    parser.add_option("-l", "--latency", type="float", default=0.0,
+                      help="Mock wiki latency per request in seconds.")
+    parser.add_option("-b", "--bandwidth", type="float", default=None,
+                      help="Mock wiki bandwidth in bytes per second.")
+    parser.add_option("-s", "--scale", type="float", default=1.0,
+                      help="Multiply the size of each benchmark.")
+    parser.add_option("-r", "--rounds", type="int", default=3,
+                      help="Rounds per benchmark, the best one counts.")
+    parser.add_option("-w", "--workers", type="int", default=4,
+                      help="Connections for the attachment transfers.")
+    parser.add_option("-o", "--output", default=None, metavar="FILE",
+                      help="Write the results to FILE instead of stdout.")
+    parser.add_option("-c", "--compare", default=None, metavar="FILE",
+                      help="Compare the results to an earlier run.")
+    parser.add_option("-t", "--threshold", type="float", default=0.2,
+                      help="Slowdown reported as a regression (0.2 = 20%).")
+    parser.add_option("--list", action="store_true", default=False,
+                      help="List the benchmarks and exit.")
+    options, names = parser.parse_args()
+
+    if options.list:
+        for name, (_, unit) in BENCHMARKS.iteritems():
+            print name, unit
+        return 0
+
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+    if not names:
+        names = BENCHMARKS.keys()
+
+    results = collections.OrderedDict()
+    for name in names:
+        print >> sys.stderr, "running", name
+        results[name] = measure(name, options)
+
+    report = collections.OrderedDict()
+    report["python"] = platform.python_version()
+    report["implementation"] = platform.python_implementation()
+    report["platform"] = platform.platform()
+    report["time"] = int(time.time())
+    report["options"] = collections.OrderedDict(
+        [("latency", options.latency),
+         ("bandwidth", options.bandwidth),
+         ("scale", options.scale),
+         ("rounds", options.rounds),
+         ("workers", options.workers)])
+    report["results"] = results
+
+    data = json.dumps(report, indent=2)
+    if options.output is None:
+        print data
+    else:
+        output = open(options.output, "w")
+        try:
+            output.write(data + "\n")
+        finally:
+            output.close()
+
+    if options.compare is not None:
+        baseline = json.load(open(options.compare))
+        if compare(results, baseline, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+    Time the XML-RPC codecs of opencollab.codec on typical payloads:
+    a large GetMeta response and the PageCache calls that
+    putAttachmentChunked sends for each chunk.
+
+    usage: python benchmarks/xmlrpc_codec.py [pages] [chunks]
+"""
+import os
+import sys
+import time
+import xmlrpclib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from opencollab.codec import StdlibCodec, FastCodec  # noqa: E402
+
+CHUNK_SIZE = 256 * 1024
+
+
+def getMetaResponse(pages, keys=10, values=3):
+    keyList = [u"key %d" % key for key in xrange(keys)]
+    rows = [keyList]
+    for page in xrange(pages):
+        row = [u"Page %d" % page]
+        for key in xrange(keys):
+            row.append([u"value <%d> of k\xe4y %d" % (value, key)
+                        for value in xrange(values)])
+        rows.append(row)
+
+    # Wrap the result like the multicall used with auth tokens
+    result = ["SUCCESS", [rows]]
+    return xmlrpclib.dumps(([result],), methodresponse=True)
+
+
+def putCacheFileCalls(chunks):
+    data = os.urandom(CHUNK_SIZE)
+    return [(u"Page", u"file.bin_%d" % index, "add",
+             xmlrpclib.Binary(data), False)
+            for index in xrange(chunks)]
+
+
+def best(func, rounds=3):
+    result = None
+    for _ in range(rounds):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if result is None or elapsed < result:
+            result = elapsed
+    return result
+
+
+def compare(title, stdlib, fast):
+    print "%-28s stdlib %7.3f s  fast %7.3f s  speedup %.1fx" % \
+        (title, stdlib, fast, stdlib / max(fast, 1e-9))
+
+
+def main():
+    args = map(int, sys.argv[1:])
+    pages, chunks = args + [5000, 40][len(args):]
+    codecs = StdlibCodec(), FastCodec()
+
+    response = getMetaResponse(pages)
+    assert codecs[0].loads(response) == codecs[1].loads(response)
+    print "GetMeta response: %d pages, %d bytes" % (pages, len(response))
+    compare("loads",
+            *[best(lambda: codec.loads(response)) for codec in codecs])
+
+    request = codecs[0].loads(response)
+    compare("dumps",
+            *[best(lambda: codec.dumps(request, "GetMeta"))
+              for codec in codecs])
+
+    calls = putCacheFileCalls(chunks)
+    print "PageCache calls: %d x %d bytes" % (chunks, CHUNK_SIZE)
+
+    def dumpAll(codec):
+        return [codec.dumps(call, "PageCache") for call in calls]
+    compare("dumps", *[best(lambda: dumpAll(codec)) for codec in codecs])
+
+    bodies = dumpAll(codecs[0])
+    assert [codecs[1].loads(body)[3].data for body in bodies] == \
+        [call[3].data for call in calls]
+    compare("loads", *[best(lambda: [codec.loads(body) for body in bodies])
+                       for codec in codecs])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+    XML-RPC codecs used by opencollab.wiki.Wiki. StdlibCodec is plain
+    xmlrpclib, FastCodec produces and accepts the same documents with
+    considerably less work per value.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+import types
+import base64
+import xmlrpclib
+from xml.parsers import expat
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+_PARAMS_HEAD = "<params>\n<param>\n"
+_PARAMS_TAIL = "</param>\n</params>\n"
+
+_XML_HEADER = "<?xml version='1.0'?>\n"
+
+
+def _escape(value):
+    if "&" in value:
+        value = value.replace("&", "&amp;")
+    if "<" in value:
+        value = value.replace("<", "&lt;")
+    if ">" in value:
+        value = value.replace(">", "&gt;")
+    return value
+
+
+def _stringify(value):
+    # Like xmlrpclib, return plain ASCII strings as str objects.
+    try:
+        return value.encode("ascii")
+    except UnicodeError:
+        return value
+
+
+def _methodCall(name, params):
+    if isinstance(name, unicode):
+        name = name.encode("utf-8", "xmlcharrefreplace")
+    return [_XML_HEADER,
+            "<methodCall>\n<methodName>", name, "</methodName>\n"] + \
+        params + ["</methodCall>\n"]
+
+
+class StdlibCodec(object):
+    """
+    The xmlrpclib codec, kept as a fallback for FastCodec.
+    """
+
+    def marshal(self, value):
+        """
+        Marshal a single value into a standalone XML-RPC <value>
+        element, so that system.multicall bodies can be assembled
+        (and measured) one call at a time.
+
+        >>> StdlibCodec().marshal([1, None])
+        '<value><array><data>\\n<value><int>1</int></value>\\n<value><nil/></value></data></array></value>\\n'
+        """
+        data = xmlrpclib.dumps((value,), allow_none=True)
+        return data[len(_PARAMS_HEAD):-len(_PARAMS_TAIL)]
+
+    def dumps(self, params, name):
+        return xmlrpclib.dumps(params, name, allow_none=True)
+
+    def unmarshaller(self):
+        return xmlrpclib.Unmarshaller()
+
+    def parser(self, target):
+        return xmlrpclib.ExpatParser(target)
+
+    def loads(self, data):
+        return self.parse([data])
+
+    def parse(self, chunks):
+        # Decode a response that arrives as a sequence of strings.
+        target = self.unmarshaller()
+        parser = self.parser(target)
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.close()
+        return target.close()
+
+
+class FastMarshaller(object):
+    # Writes values straight into one list of string pieces, which
+    # are joined only once for the whole request. Binary payloads are
+    # base64 encoded in a single pass without line breaks. Types not
+    # handled here, such as DateTime or arbitrary instances, are
+    # handed over to xmlrpclib.
+
+    def __init__(self):
+        self.memo = set()
+
+    def dump(self, value, write):
+        try:
+            func = self.dispatch[type(value)]
+        except KeyError:
+            func = FastMarshaller.dump_other
+        func(self, value, write)
+
+    dispatch = dict()
+
+    def dump_nil(self, value, write):
+        write("<value><nil/></value>")
+    dispatch[types.NoneType] = dump_nil
+
+    def dump_bool(self, value, write):
+        write(value and "<value><boolean>1</boolean></value>\n" or
+              "<value><boolean>0</boolean></value>\n")
+    dispatch[bool] = dump_bool
+
+    def dump_int(self, value, write):
+        if value > xmlrpclib.MAXINT or value < xmlrpclib.MININT:
+            raise OverflowError("int exceeds XML-RPC limits")
+        write("<value><int>%d</int></value>\n" % value)
+    dispatch[int] = dump_int
+    dispatch[long] = dump_int
+
+    def dump_double(self, value, write):
+        write("<value><double>%r</double></value>\n" % value)
+    dispatch[float] = dump_double
+
+    def dump_string(self, value, write):
+        write("<value><string>")
+        write(_escape(value))
+        write("</string></value>\n")
+    dispatch[str] = dump_string
+
+    def dump_unicode(self, value, write):
+        write("<value><string>")
+        write(_escape(value).encode("utf-8", "xmlcharrefreplace"))
+        write("</string></value>\n")
+    dispatch[unicode] = dump_unicode
+
+    def dump_array(self, value, write):
+        key = id(value)
+        if key in self.memo:
+            raise TypeError("cannot marshal recursive sequences")
+        self.memo.add(key)
+
+        dispatch = self.dispatch
+        write("<value><array><data>\n")
+        for item in value:
+            dispatch.get(type(item), FastMarshaller.dump_other)(self, item,
+                                                                write)
+        write("</data></array></value>\n")
+
+        self.memo.discard(key)
+    dispatch[tuple] = dump_array
+    dispatch[list] = dump_array
+
+    def dump_struct(self, value, write):
+        key = id(value)
+        if key in self.memo:
+            raise TypeError("cannot marshal recursive dictionaries")
+        self.memo.add(key)
+
+        dispatch = self.dispatch
+        write("<value><struct>\n")
+        for name, item in value.iteritems():
+            if type(name) is str:
+                name = _escape(name)
+            elif type(name) is unicode:
+                name = _escape(name).encode("utf-8", "xmlcharrefreplace")
+            else:
+                raise TypeError("dictionary key must be string")
+            write("<member>\n<name>")
+            write(name)
+            write("</name>\n")
+            dispatch.get(type(item), FastMarshaller.dump_other)(self, item,
+                                                                write)
+            write("</member>\n")
+        write("</struct></value>\n")
+
+        self.memo.discard(key)
+    dispatch[dict] = dump_struct
+
+    def dump_other(self, value, write):
+        if isinstance(value, xmlrpclib.Binary):
+            write("<value><base64>\n")
+            write(base64.b64encode(value.data))
+            write("\n</base64></value>\n")
+            return
+
+        marshaller = xmlrpclib.Marshaller("utf-8", True)
+        data = marshaller.dumps((value,))
+        write(data[len(_PARAMS_HEAD):-len(_PARAMS_TAIL)])
+
+
+class FastUnmarshaller(xmlrpclib.Unmarshaller):
+    # An xmlrpclib.Unmarshaller (the stack and marks work the same
+    # way) with the handling of the most common elements inlined to
+    # the end handler. Character data is collected by expat into a
+    # single string per element, see FastCodec.parser.
+
+    def __init__(self):
+        xmlrpclib.Unmarshaller.__init__(self)
+        self._text = ""
+
+    def start(self, tag, attrs):
+        if tag == "array" or tag == "struct":
+            self._marks.append(len(self._stack))
+        elif self._value and tag not in self.dispatch:
+            raise xmlrpclib.ResponseError("unknown tag %r" % tag)
+        self._text = ""
+        self._value = tag == "value"
+
+    def data(self, text):
+        self._text += text
+
+    def end(self, tag):
+        text = self._text
+        self._text = ""
+
+        if tag == "string" or tag == "name":
+            self._stack.append(_stringify(text))
+            self._value = False
+        elif tag == "value":
+            if self._value:
+                self._stack.append(_stringify(text))
+                self._value = False
+        elif tag == "member" or tag == "data" or tag == "param":
+            pass
+        elif tag == "struct":
+            mark = self._marks.pop()
+            items = self._stack[mark:]
+            self._stack[mark:] = [dict(zip(items[::2], items[1::2]))]
+            self._value = False
+        elif tag == "array":
+            mark = self._marks.pop()
+            self._stack[mark:] = [self._stack[mark:]]
+            self._value = False
+        else:
+            func = self.dispatch.get(tag, None)
+            if func is not None:
+                func(self, text)
+
+
+def _value(element):
+    # Convert a parsed <value> element. ElementTree already returns
+    # plain ASCII text as str objects.
+    if not len(element):
+        return element.text or ""
+
+    element = element[0]
+    tag = element.tag
+    if tag == "string":
+        return element.text or ""
+    if tag == "array":
+        if not len(element):
+            return []
+        return map(_value, element[0])
+    if tag == "struct":
+        struct = dict()
+        for member in element:
+            name, value = member
+            struct[name.text or ""] = _value(value)
+        return struct
+    if tag == "int" or tag == "i4" or tag == "i8":
+        return int(element.text)
+    if tag == "boolean":
+        text = element.text
+        if text == "0":
+            return False
+        if text == "1":
+            return True
+        raise TypeError("bad boolean value")
+    if tag == "double":
+        return float(element.text)
+    if tag == "nil":
+        return None
+    if tag == "base64":
+        value = xmlrpclib.Binary()
+        value.decode(element.text or "")
+        return value
+    if tag == "dateTime.iso8601":
+        value = xmlrpclib.DateTime()
+        value.decode(element.text)
+        return value
+    raise xmlrpclib.ResponseError("unknown tag %r" % tag)
+
+
+class _Parser(object):
+    def __init__(self, target):
+        self._parser = parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.buffer_size = 64 * 1024
+        parser.StartElementHandler = target.start
+        parser.EndElementHandler = target.end
+        parser.CharacterDataHandler = target.data
+        target.xml(None, None)
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse("", True)
+
+
+class FastCodec(StdlibCodec):
+    """
+    >>> codec = FastCodec()
+    >>> codec.marshal([1, None]) == StdlibCodec().marshal([1, None])
+    True
+    >>> data = codec.dumps((u"\\xe4", {"a": [1.5, True]}, "<&>"), "name")
+    >>> codec.loads(data) == StdlibCodec().loads(data)
+    True
+    >>> codec.loads(data)
+    (u'\\xe4', {'a': [1.5, True]}, '<&>')
+    >>> codec.loads(codec.dumps((xmlrpclib.Binary("\\0" * 100),), "name"))[0].data == "\\0" * 100
+    True
+    """
+
+    def _pieces(self, params):
+        pieces = ["<params>\n"]
+        write = pieces.append
+        marshaller = FastMarshaller()
+        for value in params:
+            write("<param>\n")
+            marshaller.dump(value, write)
+            write("</param>\n")
+        write("</params>\n")
+        return pieces
+
+    def marshal(self, value):
+        pieces = list()
+        FastMarshaller().dump(value, pieces.append)
+        return "".join(pieces)
+
+    def dumps(self, params, name):
+        return "".join(_methodCall(name, self._pieces(params)))
+
+    def unmarshaller(self):
+        return FastUnmarshaller()
+
+    def parse(self, chunks):
+        # Parsing the whole response into a tree is done in C, which
+        # leaves only one Python call per value. The tree takes more
+        # memory than the decoded result, which is why large results
+        # are better streamed through unmarshaller().
+        parser = ElementTree.XMLParser()
+        for chunk in chunks:
+            parser.feed(chunk)
+        root = parser.close()
+
+        element = root.find("params")
+        if element is not None:
+            return tuple(_value(param[0]) for param in element)
+
+        element = root.find("fault")
+        if element is not None:
+            raise xmlrpclib.Fault(**_value(element[0]))
+        raise xmlrpclib.ResponseError()
+
+    def parser(self, target):
+        return _Parser(target)
@@ -4,7 +4,6 @@
                         Mika Seppänen, Juhani Eronen
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
-import UserDict
 
 
 def iterate(func, values):
@@ -23,6 +22,14 @@ class Coder(object):
     def decode(self, value):
         return value
 
+    # Coders do not change after creation, so copies of metas can
+    # keep sharing them.
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
 
 class Func(Coder):
     def __init__(self, encoder=unicode, decoder=unicode):
@@ -41,16 +48,58 @@ class Func(Coder):
 Integer = Func(int)
 Float = Func(float)
 
+# Coders are stateless, so all schemaless keys share one instance.
+_coder = Coder()
+
+# Key strings are shared between all Meta instances. The builtin
+# intern() does not accept unicode strings.
+_keys = dict()
+
+
+def _intern(key):
+    return _keys.setdefault(key, key)
+
 
 class MetaKey(object):
-    def __init__(self, coder=None):
+    # A MetaKey returned for a missing key is not stored in its Meta
+    # until something is added to it. Until then _owner holds the
+    # (meta, key) pair it should be stored under.
+    #
+    # Values are validated against the coder when added, so as long
+    # as the coder stays the same every value is known to encode and
+    # the length is just the size of the set (_valid is True).
+    # Otherwise the length is counted once and cached in _count until
+    # the next change.
+    __slots__ = ("set", "coder", "_owner", "_valid", "_count")
+
+    def __init__(self, coder=None, _owner=None):
         self.set = set()
+        self.coder = None
         self._setCoder(coder)
+        self._owner = _owner
 
     def _setCoder(self, coder):
         if coder is None:
-            coder = Coder()
+            coder = _coder
+        if coder is self.coder:
+            return
         self.coder = coder
+        self._valid = not self.set
+        self._count = None
+
+    def _attach(self):
+        meta, key = self._owner
+        self._owner = None
+
+        existing = meta.dict.setdefault(key, self)
+        if existing is not self:
+            # Another view of the same key got stored first, share
+            # its values.
+            existing.set.update(self.set)
+            existing._count = None
+            self.set = existing.set
+            self._count = None
+        meta._attach()
 
     def add(self, item):
         # A trick for validating that the inserted item can both be
@@ -59,6 +108,9 @@ class MetaKey(object):
         self.coder.encode(item)
 
         self.set.add(item)
+        self._count = None
+        if self._owner is not None:
+            self._attach()
 
     def update(self, items):
         for item in items:
@@ -70,9 +122,14 @@ class MetaKey(object):
 
     def __setstate__(self, state):
         self.set, self.coder = state
+        self._owner = None
+        self._valid = not self.set
+        self._count = None
 
     def clear(self):
         self.set.clear()
+        self._valid = True
+        self._count = None
 
     def single(self, *args):
         for item in self:
@@ -86,9 +143,15 @@ class MetaKey(object):
         return iterate(self.coder.encode, self.set)
 
     def __len__(self):
-        return len(list(iter(self)))
+        if self._valid:
+            return len(self.set)
+        if self._count is None:
+            self._count = len(list(iter(self)))
+        return self._count
 
     def __nonzero__(self):
+        if self._valid:
+            return len(self.set) > 0
         return len(self) > 0
 
     def __repr__(self):
@@ -99,25 +162,139 @@ class MetaKey(object):
             return NotImplemented
         return self.set == other.set
 
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
 
-class Meta(UserDict.DictMixin):
-    def __init__(self):
-        self.dict = dict()
-        self.schema = dict()
 
-    def __getitem__(self, key):
-        if key not in self.dict:
-            self.dict[key] = MetaKey(self.schema.get(key, None))
-        return self.dict[key]
+class _Container(object):
+    # The dictionary interface shared by Meta and Metas. Only
+    # non-empty values are visible through it, and none of the
+    # methods store entries for missing keys.
+    __slots__ = ()
 
-    def __setitem__(self, key, value):
-        self.dict[key] = value
+    def keys(self):
+        return [key for key, value in self.dict.iteritems() if value]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self.dict[key]
+
+    def itervalues(self):
+        for key in self.keys():
+            yield self.dict[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get(self, key, default=None):
+        value = self.dict.get(key, None)
+        if value:
+            return value
+        return default
+
+    def __contains__(self, key):
+        value = self.dict.get(key, None)
+        if value:
+            return True
+        return False
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        return len(self.keys())
 
     def __delitem__(self, key):
         self.dict.pop(key, None)
 
-    def keys(self):
-        return [key for key, value in self.dict.iteritems() if value]
+    def pop(self, key, *args):
+        value = self.dict.pop(key, None)
+        if value:
+            return value
+        if args:
+            return args[0]
+        raise KeyError(key)
+
+    def popitem(self):
+        for key in self.keys():
+            return key, self.dict.pop(key)
+        raise KeyError("container is empty")
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        self.dict.clear()
+
+    def update(self, other=None, **keys):
+        if other is not None:
+            if hasattr(other, "keys"):
+                for key in other.keys():
+                    self[key] = other[key]
+            else:
+                for key, value in other:
+                    self[key] = value
+        for key, value in keys.iteritems():
+            self[key] = value
+
+    def __cmp__(self, other):
+        if other is None:
+            return 1
+        if isinstance(other, _Container):
+            other = dict(other.iteritems())
+        return cmp(dict(self.iteritems()), other)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class Meta(_Container):
+    __slots__ = ("dict", "schema", "_owner")
+
+    def __init__(self, _owner=None):
+        self.dict = dict()
+        self.schema = None
+        self._owner = _owner
+
+    def _attach(self):
+        if self._owner is None:
+            return
+
+        metas, page = self._owner
+        self._owner = None
+
+        existing = metas.dict.setdefault(page, self)
+        if existing is not self:
+            existing.dict.update(self.dict)
+            self.dict = existing.dict
+            self.schema = existing.schema
+
+    def __getitem__(self, key):
+        value = self.dict.get(key, None)
+        if value is not None:
+            return value
+
+        coder = None
+        if self.schema:
+            coder = self.schema.get(key, None)
+        return MetaKey(coder, (self, _intern(key)))
+
+    def __setitem__(self, key, value):
+        self.dict[_intern(key)] = value
+        self._attach()
 
     def setSchema(self, *args, **keys):
         """
@@ -139,40 +316,54 @@ class Meta(UserDict.DictMixin):
             meta._setCoder(coders.get(key, None))
         self.schema = coders
 
-    def __contains__(self, key):
-        value = self.dict.get(key, None)
-        if value:
-            return True
-        return False
+    # Methods for pickle, also accepting the instance dictionaries
+    # pickled by earlier versions.
+    def __getstate__(self):
+        return self.dict, self.schema
 
-    def has_key(self, key):
-        return key in self
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = state["dict"], state.get("schema", None)
+        self.dict, self.schema = state
+        self._owner = None
 
 
 # Just a container for many pages of meta
-class Metas(UserDict.DictMixin):
+class Metas(_Container):
+    """
+    Looking up missing pages or keys does not store anything:
+
+    >>> metas = Metas()
+    >>> list(metas["page"]["key"])
+    []
+    >>> metas.dict
+    {}
+    >>> metas["page"]["key"].add(u"value")
+    >>> metas
+    {'page': {'key': [u'value']}}
+    """
+    __slots__ = ("dict",)
+
     def __init__(self):
         self.dict = dict()
 
     def __getitem__(self, key):
-        if key not in self.dict:
-            self.dict[key] = Meta()
-        return self.dict[key]
-
-    def __delitem__(self, key):
-        self.dict.pop(key, None)
+        value = self.dict.get(key, None)
+        if value is not None:
+            return value
+        return Meta((self, key))
 
     def __setitem__(self, key, val):
+        if isinstance(val, Meta):
+            val._owner = None
         self.dict[key] = val
 
-    def keys(self):
-        return [key for key, value in self.dict.iteritems() if value]
-
-    def __contains__(self, key):
-        value = self.dict.get(key, None)
-        if value:
-            return True
-        return False
+    # Methods for pickle, also accepting the instance dictionaries
+    # pickled by earlier versions.
+    def __getstate__(self):
+        return (self.dict,)
 
-    def has_key(self, key):
-        return key in self
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            state = (state["dict"],)
+        self.dict, = state
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+
+import time
+import sqlite3
+import cPickle
+import threading
+import collections
+
+
+class Cache(object):
+    """
+    A read-through cache for wiki calls: an in-process LRU of at most
+    size entries, optionally backed by an SQLite file that keeps up
+    to diskSize entries between runs. Each cached method has its own
+    time to live in seconds (ttls); methods without one are not
+    cached. Values are stored pickled, so every hit returns a fresh
+    copy that the caller is free to modify.
+
+    Entries are tied to the page they were read from, or to no page
+    at all for searches, whose results may change whenever any page
+    changes.
+
+    >>> cache = Cache(size=2)
+    >>> args = (u"FrontPage",)
+    >>> cache.get("getPage", args)
+    (False, None)
+    >>> cache.put("getPage", args, u"content", page=u"FrontPage")
+    >>> cache.get("getPage", args)
+    (True, u'content')
+    >>> cache.invalidate(u"FrontPage")
+    >>> cache.get("getPage", args)
+    (False, None)
+    >>> cache.get("getAttachment", args)
+    (False, None)
+    >>> print cache
+    Cache hits 1, misses 2, evictions 0
+
+    A value read before an invalidation is not stored after it, when
+    put is given the generation from before the read.
+
+    >>> generation = cache.generation
+    >>> cache.invalidate(u"FrontPage")
+    >>> cache.put("getPage", args, u"old content", u"FrontPage", generation)
+    >>> cache.get("getPage", args)
+    (False, None)
+    """
+
+    DEFAULT_TTLS = {
+        "getPage": 300,
+        "getPageHTML": 300,
+        "getMeta": 60
+    }
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        key BLOB PRIMARY KEY,
+        page TEXT,
+        expires REAL NOT NULL,
+        used REAL NOT NULL,
+        value BLOB NOT NULL
+    )
+    """
+
+    def __init__(self, size=1000, path=None, diskSize=10000, ttls=None):
+        self.size = size
+        self.diskSize = diskSize
+        self.ttls = dict(self.DEFAULT_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Incremented on each invalidation
+        self.generation = 0
+
+        # key -> (page, expires, pickled value), least recently used
+        # first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(self.SCHEMA)
+
+    def _key(self, method, args):
+        return cPickle.dumps((method, args), 2)
+
+    def _decode(self, value):
+        if isinstance(value, str):
+            return value.decode("utf-8", "replace")
+        return value
+
+    def _remember(self, key, entry):
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _load(self, key, now):
+        if self.db is None:
+            return None
+
+        row = self.db.execute("SELECT page, expires, value FROM entries " +
+                              "WHERE key = ?",
+                              (sqlite3.Binary(key),)).fetchone()
+        if row is None:
+            return None
+
+        page, expires, value = row
+        if expires <= now:
+            self.db.execute("DELETE FROM entries WHERE key = ?",
+                            (sqlite3.Binary(key),))
+            return None
+
+        self.db.execute("UPDATE entries SET used = ? WHERE key = ?",
+                        (now, sqlite3.Binary(key)))
+        return page, expires, str(value)
+
+    def _store(self, key, entry, now):
+        if self.db is None:
+            return
+
+        page, expires, value = entry
+        self.db.execute("INSERT OR REPLACE INTO entries " +
+                        "(key, page, expires, used, value) " +
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (sqlite3.Binary(key), page, expires, now,
+                         sqlite3.Binary(value)))
+
+        count, = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()
+        if count > self.diskSize:
+            extra = count - self.diskSize
+            self.db.execute("DELETE FROM entries WHERE key IN " +
+                            "(SELECT key FROM entries " +
+                            "ORDER BY used LIMIT ?)", (extra,))
+            self.evictions += extra
+        self.db.commit()
+
+    def get(self, method, args):
+        """
+        Return (True, value) for a cached call that has not expired
+        yet, (False, None) otherwise.
+        """
+        # Methods without a time to live are never cached, and their
+        # calls do not count as misses.
+        if not self.ttls.get(method, None):
+            return False, None
+
+        key = self._key(method, args)
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None and entry[1] <= now:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                entry = self._load(key, now)
+                if entry is None:
+                    self.misses += 1
+                    return False, None
+
+            self._remember(key, entry)
+            self.hits += 1
+            return True, cPickle.loads(entry[2])
+
+    def put(self, method, args, value, page=None, generation=None):
+        """
+        Cache the value returned by method(*args), read from the
+        given page. Given the generation of the cache from before the
+        value was read, the value is dropped if anything has been
+        invalidated since.
+        """
+        ttl = self.ttls.get(method, None)
+        if not ttl:
+            return
+
+        key = self._key(method, args)
+        now = time.time()
+        entry = self._decode(page), now + ttl, cPickle.dumps(value, 2)
+
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remember(key, entry)
+            self._store(key, entry, now)
+
+    def invalidate(self, page):
+        """
+        Drop the entries read from the given page, as well as all
+        search results.
+        """
+        page = self._decode(page)
+        with self._lock:
+            self.generation += 1
+            for key, entry in self._entries.items():
+                if entry[0] is None or entry[0] == page:
+                    del self._entries[key]
+
+            if self.db is not None:
+                self.db.execute("DELETE FROM entries " +
+                                "WHERE page IS NULL OR page = ?", (page,))
+                self.db.commit()
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM entries")
+                self.db.commit()
+
+    def stats(self):
+        return dict(hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions)
+
+    def __str__(self):
+        return "Cache hits %(hits)d, misses %(misses)d, " \
+            "evictions %(evictions)d" % self.stats()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
+
+class AttachmentIndex(object):
+    """
+    Remembers the attachments uploaded to each page by content: the
+    MD5 digest and size of the whole file, as also returned by
+    getAttachmentInfo, and the digests of its chunks. The index is
+    kept in an SQLite file (in memory by default) of at most size
+    entries, dropping the least recently used ones first.
+
+    The chunks of an upload stay in the page cache of the page they
+    were sent to, so a known file can only be reassembled without
+    resending its data on that same page.
+
+    >>> index = AttachmentIndex()
+    >>> index.find(u"Page", u"a.txt")
+    >>> index.add(u"Page", u"a.txt", "0cc175b9c0f1b6a831c399e269772661",
+    ...           1, 1024, ["0cc175b9c0f1b6a831c399e269772661"])
+    >>> index.find(u"Page", u"a.txt")
+    ('0cc175b9c0f1b6a831c399e269772661', 1)
+    >>> index.chunks("0cc175b9c0f1b6a831c399e269772661", 1, 1024)
+    ['0cc175b9c0f1b6a831c399e269772661']
+    >>> index.cached(u"Page", "0cc175b9c0f1b6a831c399e269772661", 1)
+    True
+    >>> index.cached(u"Other", "0cc175b9c0f1b6a831c399e269772661", 1)
+    False
+
+    Finding an entry counts as using it.
+
+    >>> index = AttachmentIndex(size=2)
+    >>> for name in u"a.txt", u"b.txt":
+    ...     index.add(u"Page", name, "0cc175b9c0f1b6a831c399e269772661",
+    ...               1, 1024, ["0cc175b9c0f1b6a831c399e269772661"])
+    >>> index.find(u"Page", u"a.txt")
+    ('0cc175b9c0f1b6a831c399e269772661', 1)
+    >>> index.add(u"Page", u"c.txt", "0cc175b9c0f1b6a831c399e269772661",
+    ...           1, 1024, ["0cc175b9c0f1b6a831c399e269772661"])
+    >>> index.find(u"Page", u"b.txt")
+    >>> index.find(u"Page", u"a.txt")
+    ('0cc175b9c0f1b6a831c399e269772661', 1)
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS attachments (
+        page TEXT NOT NULL,
+        filename TEXT NOT NULL,
+        digest TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        chunkSize INTEGER NOT NULL,
+        chunks TEXT NOT NULL,
+        used REAL NOT NULL,
+        PRIMARY KEY (page, filename)
+    )
+    """
+
+    SCHEMA_INDEX = """
+    CREATE INDEX IF NOT EXISTS attachments_digest
+    ON attachments (digest, size)
+    """
+
+    def __init__(self, path=":memory:", size=100000):
+        self.size = size
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(self.SCHEMA)
+        self.db.execute(self.SCHEMA_INDEX)
+
+    def _text(self, value):
+        if isinstance(value, str):
+            return value.decode("utf-8", "replace")
+        return value
+
+    def _use(self, rowid):
+        self.db.execute("UPDATE attachments SET used = ? WHERE rowid = ?",
+                        (time.time(), rowid))
+
+    def find(self, page, filename):
+        """
+        Return the (digest, size) of the file last uploaded as the
+        given attachment, or None.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT rowid, digest, size " +
+                                  "FROM attachments " +
+                                  "WHERE page = ? AND filename = ?",
+                                  (self._text(page),
+                                   self._text(filename))).fetchone()
+            if row is None:
+                return None
+            self._use(row[0])
+        return str(row[1]), row[2]
+
+    def chunks(self, digest, size, chunkSize):
+        """
+        Return the chunk digests of any file uploaded with the given
+        digest, size and chunk size, or None.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT rowid, chunks FROM attachments " +
+                                  "WHERE digest = ? AND size = ? " +
+                                  "AND chunkSize = ? LIMIT 1",
+                                  (digest, size, chunkSize)).fetchone()
+            if row is None:
+                return None
+            self._use(row[0])
+        return str(row[1]).split()
+
+    def cached(self, page, digest, size):
+        """
+        Return whether a file with the given digest and size has been
+        uploaded to the page, under any name.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT rowid FROM attachments " +
+                                  "WHERE page = ? AND digest = ? " +
+                                  "AND size = ? LIMIT 1",
+                                  (self._text(page), digest,
+                                   size)).fetchone()
+            if row is None:
+                return False
+            self._use(row[0])
+        return True
+
+    def add(self, page, filename, digest, size, chunkSize, chunks):
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO attachments " +
+                            "(page, filename, digest, size, chunkSize, " +
+                            "chunks, used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (self._text(page), self._text(filename),
+                             digest, size, chunkSize, " ".join(chunks),
+                             time.time()))
+
+            count, = self.db.execute("SELECT COUNT(*) " +
+                                     "FROM attachments").fetchone()
+            if count > self.size:
+                self.db.execute("DELETE FROM attachments WHERE rowid IN " +
+                                "(SELECT rowid FROM attachments " +
+                                "ORDER BY used LIMIT ?)",
+                                (count - self.size,))
+            self.db.commit()
+
+    def discard(self, page, filename):
+        with self._lock:
+            self.db.execute("DELETE FROM attachments " +
+                            "WHERE page = ? AND filename = ?",
+                            (self._text(page), self._text(filename)))
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import re
+import codecs
+import threading
+import collections
+
+# Codecs tried, in order, for text without a usable charset. The
+# last one decodes anything. Korean and Japanese text decodes as gbk
+# as well, so their codecs come first.
+SHORTLIST = ("utf-8", "euc-kr", "shift_jis", "gbk", "windows-1251",
+             "koi8-r", "windows-1252", "iso-8859-1")
+
+# Bytes of the payload looked at before deciding on a codec
+PREFIX = 8192
+
+# Non-ASCII bytes in the prefix below which the statistics are too
+# weak to go by. The codec earlier used by the sender wins, and
+# otherwise only the codecs outside _SCRIPTS are tried.
+EVIDENCE = 16
+
+_HIGH = "".join(map(chr, range(128, 256)))
+_runs = re.compile("[\x80-\xff]+")
+_nonAscii = re.compile(u"[^\x00-\x7f]")
+
+# Characters that most of the non-ASCII text decoded with a multibyte
+# or Cyrillic codec should consist of, and their required share.
+# Wrong guesses decode into other scripts, or into upper case.
+_SCRIPTS = {
+    "euc_kr": (re.compile(u"[\uac00-\ud7a3]"), 0.7),
+    "shift_jis": (re.compile(u"[\u3000-\u30ff\u4e00-\u9fff\uff01-\uff60]"), 0.5),
+    "gbk": (re.compile(u"[\u3000-\u303f\u4e00-\u9fff\uff01-\uff60]"), 0.5),
+    "cp1251": (re.compile(u"[\u0430-\u044f\u0451]"), 0.5),
+    "koi8-r": (re.compile(u"[\u0430-\u044f\u0451]"), 0.5),
+}
+
+
+def _count(data, chars):
+    # The number of bytes of data that are in chars
+    return len(data) - len(data.translate(None, chars))
+
+
+def _share(pattern, text):
+    total = len(_nonAscii.findall(text))
+    return len(pattern.findall(text)) / float(max(total, 1))
+
+
+class _Stats(object):
+    # Cheap byte statistics of a payload prefix
+
+    def __init__(self, prefix):
+        self.high = _count(prefix, _HIGH)
+        runs = _runs.findall(prefix)
+        self.runLength = float(self.high) / max(len(runs), 1)
+
+    def words(self):
+        # Whole words of high bytes, as in Cyrillic and CJK text,
+        # rather than an accented letter here and there.
+        return self.runLength >= 2.0
+
+
+def _fits(codec, stats, evidence):
+    if codec in _SCRIPTS:
+        return stats.high >= evidence and stats.words()
+    return True
+
+
+def codecName(charset):
+    """
+    Return the canonical name of the codec for a charset, or None if
+    there is no such codec.
+
+    >>> codecName("UTF8"), codecName("latin1"), codecName("x-unknown")
+    ('utf-8', 'iso8859-1', None)
+    """
+    try:
+        return codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        return None
+
+
+def _decodes(codec, prefix, final):
+    # Whether the prefix decodes strictly into the expected script. A
+    # multibyte character may be cut at the end of a prefix shorter
+    # than the payload, so then the decoder is not told that the data
+    # ends there.
+    decoder = codecs.getincrementaldecoder(codec)("strict")
+    try:
+        text = decoder.decode(prefix, final)
+    except UnicodeDecodeError:
+        return False
+
+    if codec in _SCRIPTS:
+        pattern, share = _SCRIPTS[codec]
+        return _share(pattern, text) >= share
+    return True
+
+
+class CharsetResolver(object):
+    """
+    Decides how to decode text parts without a usable charset. The
+    deduplicated shortlist of codecs is tried in order on a prefix of
+    the payload, guided by byte statistics of the prefix, and only
+    the chosen codec decodes the whole payload. Clear decisions are
+    cached per sender domain, and settle the parts of the same sender
+    too short to tell.
+
+    >>> resolver = CharsetResolver()
+    >>> resolver.resolve("plain text")
+    'ascii'
+    >>> resolver.resolve(u"caf\\xe9 cr\\xe8me".encode("utf-8"))
+    'utf-8'
+    >>> resolver.resolve(u"caf\\xe9 cr\\xe8me".encode("windows-1252"))
+    'cp1252'
+    >>> text = u"\\u043f\\u0440\\u0438\\u0432\\u0435\\u0442 \\u043c\\u0438\\u0440 " * 2
+    >>> resolver.resolve(text.encode("koi8-r"))
+    'koi8-r'
+    >>> resolver.resolve(text.encode("windows-1251"))
+    'cp1251'
+    >>> resolver.resolve((u"\\u4e2d\\u6587 \\u6d4b\\u8bd5 " * 2).encode("gbk"))
+    'gbk'
+    >>> resolver.resolve("data", "x-unknown")
+    'ascii'
+
+    A lone word is no evidence for a multibyte or Cyrillic codec,
+    unless the sender is known.
+
+    >>> word = u"\\u0434\\u0430".encode("windows-1251")
+    >>> resolver.resolve(word)
+    'cp1252'
+    >>> resolver.resolve(text.encode("windows-1251"), domain="example.ru")
+    'cp1251'
+    >>> resolver.resolve(word, domain="example.ru")
+    'cp1251'
+    >>> resolver.decode("caf\\xe9", "latin1")
+    u'caf\\xe9'
+    """
+
+    def __init__(self, shortlist=SHORTLIST, prefix=PREFIX,
+                 evidence=EVIDENCE, cacheSize=10000):
+        self.shortlist = list()
+        for charset in shortlist:
+            codec = codecName(charset)
+            if codec is not None and codec not in self.shortlist:
+                self.shortlist.append(codec)
+
+        self.prefix = prefix
+        self.evidence = evidence
+        self.cacheSize = cacheSize
+        self._domains = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, domain):
+        with self._lock:
+            return self._domains.get(domain, None)
+
+    def _remember(self, domain, codec):
+        with self._lock:
+            self._domains.pop(domain, None)
+            self._domains[domain] = codec
+            while len(self._domains) > self.cacheSize:
+                self._domains.popitem(last=False)
+
+    def resolve(self, payload, charset=None, domain=None):
+        """
+        Return the name of the codec to decode payload with. A
+        charset with a known codec is used as is.
+        """
+        if charset is not None:
+            codec = codecName(charset)
+            if codec is not None:
+                return codec
+
+        prefix = payload[:self.prefix]
+        final = len(prefix) == len(payload)
+        stats = _Stats(prefix)
+        if not stats.high:
+            if final or not _count(payload, _HIGH):
+                return "ascii"
+            prefix, final = payload, True
+            stats = _Stats(prefix)
+
+        if domain is not None and stats.high < self.evidence:
+            cached = self.cached(domain)
+            if cached is not None and _decodes(cached, prefix, final):
+                return cached
+
+        for codec in self.shortlist:
+            if _fits(codec, stats, self.evidence) and \
+                    _decodes(codec, prefix, final):
+                break
+        else:
+            codec = "iso8859-1"
+
+        if domain is not None and stats.high >= self.evidence:
+            self._remember(domain, codec)
+        return codec
+
+    def decode(self, payload, charset=None, domain=None):
+        codec = self.resolve(payload, charset, domain)
+        return unicode(payload, codec, "ignore")
@@ -21,7 +21,8 @@ def parseConfig(config):
 
 
 def parseOptions(specparser, inisection, x509capath=True, x509=True,
-                 config=True, category=False, search=False, template=False):
+                 config=True, category=False, search=False, template=False,
+                 stats=False):
     cliopts = {}
     globalopts = {}
     globalopts[inisection] = {}
@@ -59,6 +60,10 @@ def parseOptions(specparser, inisection, x509capath=True, x509=True,
     genparser.add_option("-U", "--username", action="store",
                          type="string", dest="username", default=None,
                          metavar="USERNAME", help="USERNAME to use in collab auth.")
+    if stats:
+        genparser.add_option("--stats", action="store_true", default=False,
+                             dest="stats",
+                             help="Print request latency and throughput statistics.")
     genparser.add_option("-v", "--verbose", action="store_true",
                          dest="verbose", help="Enable verbose output.")
     clivalues, args = genparser.parse_args()
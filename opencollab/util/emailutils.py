@@ -5,18 +5,18 @@
 """
 import re
 import sys
-import copy
 import time
 import email
 import socket
 import getpass
 import imaplib
 import cStringIO
-import encodings
+import collections
 import mimetypes
 import HTMLParser
 
 from opencollab.meta import Metas
+from opencollab.util.charset import CharsetResolver
 from opencollab.util.file import hashFile, uploadFile
 from opencollab.util.regexp import fqdn_re, url_all_re
 
@@ -29,9 +29,29 @@ except:
     from email.Utils import getaddresses
 
 
-def imapAuth(imapserver, imapuser, imappass):
+# Messages fetched with one IMAP command
+FETCH_BATCH = 50
+
+# HTML is parsed this many characters at a time
+HTML_CHUNK = 64 * 1024
+
+# Characters kept between chunks for the end tag of a script or style
+HTML_TAG_TAIL = 64
+
+# Decides the codecs of text parts without a usable charset
+_charsets = CharsetResolver()
+
+
+def imapAuth(imapserver, imapuser, imappass, ssl=True):
+    # The server may be given as host:port
+    host, port = imapserver, None
+    if ':' in imapserver:
+        host, port = imapserver.rsplit(':', 1)
     try:
-        mailbox = imaplib.IMAP4_SSL(imapserver)
+        if ssl:
+            mailbox = imaplib.IMAP4_SSL(host, int(port or imaplib.IMAP4_SSL_PORT))
+        else:
+            mailbox = imaplib.IMAP4(host, int(port or imaplib.IMAP4_PORT))
     except imaplib.socket.gaierror:
         error = 'ERROR: No address associated with hostname: ' + imapserver
         raise NameError(error)
@@ -59,29 +79,228 @@ def decodePayload(charset, payload):
         return dec_payload
 
 
-def getMessagesAndUpload(mailbox, collab):
-    metas = Metas()
+def decodePart(charset, payload, domain=None):
+    # Decode a text part with its own charset, or else with the one
+    # the payload looks like (see CharsetResolver), given the domain
+    # of the sender.
+    return _charsets.decode(payload, charset, domain)
+
+
+def senderDomain(msg):
+    """
+    >>> senderDomain(email.message_from_string("From: A <a@Example.COM>"))
+    'example.com'
+    """
+    for name, address in getaddresses(msg.get_all('From', [])):
+        if '@' in address:
+            return address.rsplit('@', 1)[1].lower()
+    return None
+
+
+def partName(part, counter):
+    filename = part.get_filename()
+    if filename is None:
+        ext = mimetypes.guess_extension(part.get_content_type())
+        if not ext:
+            ext = '.bin'
+        filename = 'part-%03d%s' % (counter, ext)
+    return filename
+
+
+def messageSet(nums):
+    """
+    Return an IMAP message set of the given message numbers, with
+    the consecutive ones as ranges.
+
+    >>> messageSet(['1', '2', '3', '5', '7', '8'])
+    '1:3,5,7:8'
+    """
+    ranges = list()
+    for num in map(int, nums):
+        if ranges and ranges[-1][1] == num - 1:
+            ranges[-1][1] = num
+        else:
+            ranges.append([num, num])
+    return ",".join(str(first) if first == last else "%d:%d" % (first, last)
+                    for first, last in ranges)
+
+
+_sizeResponse = re.compile(r'^(\d+) \(.*RFC822\.SIZE (\d+)')
+
+
+def messageSizes(mailbox, nums):
+    # Return a dict of the sizes of the given messages in bytes
+    typ, data = mailbox.fetch(messageSet(nums), '(RFC822.SIZE)')
+    sizes = dict()
+    for line in data:
+        if isinstance(line, tuple):
+            line = line[0]
+        match = _sizeResponse.match(line or "")
+        if match:
+            sizes[match.group(1)] = int(match.group(2))
+    return sizes
+
+
+def fetchBatches(nums, batchSize, sizes=None, maxBytes=None):
+    """
+    Split message numbers into batches of at most batchSize messages
+    and, given their sizes, of at most maxBytes bytes. Messages larger
+    than maxBytes get a batch of their own.
+
+    >>> list(fetchBatches(['1', '2', '3', '4', '5'], 2))
+    [['1', '2'], ['3', '4'], ['5']]
+    >>> sizes = {'1': 10, '2': 10, '3': 30, '4': 5}
+    >>> list(fetchBatches(['1', '2', '3', '4'], 10, sizes, 25))
+    [['1', '2'], ['3'], ['4']]
+    """
+    batch = list()
+    total = 0
+    for num in nums:
+        size = 0
+        if sizes is not None:
+            size = sizes.get(num, 0)
+        if batch and (len(batch) >= batchSize or
+                      (maxBytes is not None and total + size > maxBytes)):
+            yield batch
+            batch = list()
+            total = 0
+        batch.append(num)
+        total += size
+    if batch:
+        yield batch
+
+
+def fetchMessages(mailbox, batchSize=FETCH_BATCH, maxBytes=None):
+    # Yield the raw UNSEEN messages of the mailbox one at a time. They
+    # are fetched batchSize messages per command. Given maxBytes, the
+    # message sizes are asked first, and a batch is cut short before
+    # it grows over maxBytes.
     mailbox.select()
     try:
         typ, data = mailbox.search(None, 'UNSEEN')
     except:
         error = 'ERROR: IMAP search failed'
         sys.exit(error)
-    for num in data[0].split():
-        try:
-            typ, data = mailbox.fetch(num, '(RFC822)')
-        except:
-            error = 'ERROR: IMAP fetch failed'
-            sys.exit(error)
-        msg = email.message_from_string(data[0][1])
-        msg_obj = cStringIO.StringIO(data[0][1])
-        cpage = hashFile(msg_obj)
-        epoch = int(time.time())
-        metas[cpage]["ATTRIBUTION"].add('<<DateTime(%s)>>' % epoch)
-        metas[cpage]["RFC822 Message"].add('[[attachment:%s.txt]]' % cpage)
-        metas[cpage]["TYPE"].add("SPAM")
+    nums = data[0].split()
+    if not nums:
+        return
+
+    sizes = None
+    try:
+        if maxBytes is not None:
+            sizes = messageSizes(mailbox, nums)
+        for batch in fetchBatches(nums, batchSize, sizes, maxBytes):
+            typ, data = mailbox.fetch(messageSet(batch), '(RFC822)')
+            for item in data:
+                if isinstance(item, tuple):
+                    yield item[1]
+    except (imaplib.IMAP4.error, socket.error):
+        error = 'ERROR: IMAP fetch failed'
+        sys.exit(error)
+
+
+def messagePage(metas, data):
+    cpage = hashFile(cStringIO.StringIO(data))
+    epoch = int(time.time())
+    metas[cpage]["ATTRIBUTION"].add('<<DateTime(%s)>>' % epoch)
+    metas[cpage]["RFC822 Message"].add('[[attachment:%s.txt]]' % cpage)
+    metas[cpage]["TYPE"].add("SPAM")
+    return cpage
+
+
+def analyseMessage(data, upload=None):
+    """
+    Return the Metas of a raw message: its page, named after the hash
+    of the message, with the headers, lexemes and URLs found in it,
+    and the pages of the hosts the URLs point to. The message is
+    walked once. The message itself and its parts other than text
+    are given to upload(page, data, filename) on the way.
+
+    >>> data = "\\r\\n".join(["From: a@example.com", "To: b@example.com",
+    ...                       "Subject: Hi", "Content-Type: text/html", "",
+    ...                       "<b>Cheap</b> http://spam.example.com/"])
+    >>> metas = analyseMessage(data)
+    >>> sorted(metas)
+    ['1257afd6cc94db8fa4fb36f74c66562f', 'spam.example.com']
+    >>> meta = metas['1257afd6cc94db8fa4fb36f74c66562f']
+    >>> sorted(meta["Lexeme"]), sorted(meta["SPAM URL"])
+    ([u'[[cheap]]'], ['http://spam.example.com/'])
+    >>> sorted(metas["spam.example.com"]["TYPE"])
+    ['NAME']
+    """
+    metas = Metas()
+    cpage = messagePage(metas, data)
+    if upload is not None:
+        upload(cpage, data, cpage + '.txt')
+
+    msg = email.message_from_string(data)
+    headerMetas(metas[cpage], msg)
+    domain = senderDomain(msg)
+
+    texts = set()
+    counter = 1
+    for part in msg.walk():
+        if part.get_content_maintype() == 'multipart':
+            continue
+        ctype = part.get_content_type()
+        if ctype == 'text/plain' or ctype == 'text/html':
+            payload = part.get_payload(decode=True)
+            urlMetas(metas, cpage, payload)
+            dec_payload = decodePart(part.get_content_charset(), payload,
+                                     domain)
+            if ctype == 'text/html':
+                dec_payload = htmlText(dec_payload)
+            if dec_payload is not None:
+                texts.add(dec_payload)
+        else:
+            filename = partName(part, counter)
+            ufile = part.get_payload(decode=True)
+            if ufile:
+                metas[cpage]["Attachment"].add('[[attachment:%s]]' % filename)
+                if upload is not None:
+                    upload(cpage, ufile, filename)
+        counter += 1
+
+    for text in texts:
+        metas[cpage]["Lexeme"].update("[[%s]]" % token
+                                      for token in lexemes(text))
+    return metas
+
+
+def readMessages(mailbox, collab, index=None, workers=1,
+                 batchSize=FETCH_BATCH, maxBytes=None):
+    # Yield the Metas of the UNSEEN messages one at a time (see
+    # analyseMessage and fetchMessages). Each message and its
+    # attachments are uploaded to its page by a pool of workers
+    # threads, while the following messages are fetched and analysed.
+    # Upload errors are raised here as they are noticed.
+    with collab.executor(workers) as executor:
+        pending = collections.deque()
+
+        def upload(page, data, filename):
+            pending.append(executor.submit(uploadFile, collab, page, None,
+                                           filename, data=data, index=index))
+
+        for data in fetchMessages(mailbox, batchSize, maxBytes):
+            metas = analyseMessage(data, upload)
+            while pending and pending[0].done():
+                pending.popleft().result()
+            yield metas
+
+        while pending:
+            pending.popleft().result()
+
+
+def getMessagesAndUpload(mailbox, collab, index=None):
+    # Collects the messages with their decoded text and html parts
+    # for the parse functions below. Prefer readMessages, which does
+    # not keep the messages around.
+    metas = Metas()
+    for data in fetchMessages(mailbox):
+        cpage = messagePage(metas, data)
+        msg = email.message_from_string(data)
         metas[cpage]["msg"].add(msg)
-        uploadFile(collab, cpage, data[0][1], cpage + '.txt')
+        uploadFile(collab, cpage, None, cpage + '.txt', data=data, index=index)
         counter = 1
         for part in msg.walk():
             if part.get_content_maintype() == 'multipart':
@@ -90,141 +309,198 @@ def getMessagesAndUpload(mailbox, collab):
             if ctype == 'text/plain' or ctype == 'text/html':
                 charset = part.get_content_charset()
                 payload = part.get_payload(decode=True)
-                if charset is not None:
-                    dec_payload = decodePayload(charset, payload)
-                else:
-                    dec_payload = None
-                if dec_payload is None:
-                    for ch in encodings.aliases.aliases.values():
-                        dec_payload = decodePayload(ch, payload)
-                        if dec_payload is not None:
-                            break
-                    if dec_payload is None:
-                        dec_payload = "unsupported-charset"
+                dec_payload = decodePart(charset, payload)
                 if ctype == 'text/plain':
                     metas[cpage]["text"].add(dec_payload)
                 else:
                     metas[cpage]["html"].add(dec_payload)
             else:
-                filename = part.get_filename()
-                if filename is None:
-                    ext = mimetypes.guess_extension(part.get_content_type())
-                    if not ext:
-                        ext = '.bin'
-                    filename = 'part-%03d%s' % (counter, ext)
+                filename = partName(part, counter)
                 ufile = part.get_payload(decode=True)
                 if ufile:
                     metas[cpage]["Attachment"].add('[[attachment:%s]]' % filename)
-                    uploadFile(collab, cpage, ufile, filename)
+                    uploadFile(collab, cpage, None, filename, data=ufile,
+                               index=index)
             counter += 1
     return metas
 
 
+_quotes = re.compile('(^[\"\']|[\"\']$)')
+_markup = re.compile('[\#<>\[\]\(\)\{\}]')
+_punct = re.compile('[\.,:;]\s?$')
+_rest = re.compile('[\x12\xab\xbb]')
+
+
+def lexemes(text):
+    """
+    Yield the lowercased words of text, without quotes, markup and
+    trailing punctuation. URLs are left out.
+
+    >>> list(lexemes(u'"Buy" [NOW], http://example.com'))
+    [u'buy', u'now']
+    """
+    for token in text.split():
+        if url_all_re.search(token):
+            continue
+        token = _quotes.sub('', token)
+        token = _markup.sub('', token)
+        token = _punct.sub('', token)
+        token = _rest.sub('', token)
+        yield token.lower()
+
+
 def lexifyTokens(metas):
-    quotes = re.compile('(^[\"\']|[\"\']$)')
-    markup = re.compile('[\#<>\[\]\(\)\{\}]')
-    punct = re.compile('[\.,:;]\s?$')
-    rest = re.compile('[\x12\xab\xbb]')
-    new_metas = copy.deepcopy(metas)
+    # The metas are changed in place and returned.
     for cpage in metas:
         for text in metas[cpage]["text"]:
-            shred = []
-            shred = text.split()
-            for token in shred:
-                if url_all_re.search(token):
-                    pass
-                else:
-                    token = quotes.sub('', token)
-                    token = markup.sub('', token)
-                    token = punct.sub('', token)
-                    token = rest.sub('', token)
-                    token = token.lower()
-                    new_metas[cpage]["Lexeme"].add("[[%s]]" % token)
-                    # Scalability issues. :)
-                    # if token:
-                    #     new_metas[token]["TYPE"].add("LEXEME")
-    return new_metas
+            metas[cpage]["Lexeme"].update("[[%s]]" % token
+                                          for token in lexemes(text))
+    return metas
 
 
 class html(HTMLParser.HTMLParser):
     """
     From http://pleac.sourceforge.net/pleac_python/webautomation.html
-    """
-    def __init__(self):
-        HTMLParser.HTMLParser.__init__(self)
-        self._plaintext = ""
-        self._ignore = False
 
-    def handle_starttag(self, tag, attrs):
-        if tag == "script":
-            self._ignore = True
+    Collects the text of the document in fragments. The content of
+    script and style elements is dropped as it is fed, instead of
+    being kept until their end tag.
+    """
+    def reset(self):
+        HTMLParser.HTMLParser.reset(self)
+        self._fragments = list()
 
-    def handle_endtag(self, tag):
-        if tag == "script":
-            self._ignore = False
+    def feed(self, data):
+        if self.cdata_elem is not None:
+            data = self.rawdata + data
+            self.rawdata = ""
+            match = self.interesting.search(data)
+            if match is None:
+                # Keep what may be the start of the end tag
+                tail = data.rfind("<", -HTML_TAG_TAIL)
+                if tail >= 0:
+                    self.rawdata = data[tail:]
+                return
+            data = data[match.start():]
+        HTMLParser.HTMLParser.feed(self, data)
 
     def handle_data(self, data):
-        if len(data) > 0 and not self._ignore:
-            self._plaintext += data
+        if len(data) > 0 and self.cdata_elem is None:
+            self._fragments.append(data)
+
+    def fragments(self):
+        # Return the fragments collected since the last call
+        fragments, self._fragments = self._fragments, list()
+        return fragments
 
     def get_plaintext(self):
-        return self._plaintext
+        return "".join(self._fragments)
 
     def error(self, msg):
         # ignore all errors
         pass
 
 
+def htmlFragments(html_part, parser=None, chunkSize=HTML_CHUNK):
+    """
+    Yield the text of an HTML document in fragments, as it is parsed
+    a chunk at a time. Words may be split between fragments. The
+    document may also be given as an iterable of chunks. A parser
+    (see html) can be given to be reused.
+
+    >>> doc = "<style>p {}</style><p>Cheap <b>pills</b><script>x<y</script>"
+    >>> list(htmlFragments(doc, chunkSize=16))
+    ['Cheap ', 'p', 'ills']
+    """
+    if parser is None:
+        parser = html()
+    else:
+        parser.reset()
+
+    chunks = html_part
+    if isinstance(html_part, basestring):
+        chunks = (html_part[start:start + chunkSize]
+                  for start in xrange(0, len(html_part), chunkSize))
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for fragment in parser.fragments():
+            yield fragment
+    parser.close()  # force processing all data
+    for fragment in parser.fragments():
+        yield fragment
+
+
+def htmlText(html_part, parser=None):
+    # The plain text of an HTML document, or None if it does not parse
+    try:
+        return "".join(htmlFragments(html_part, parser))
+    except:
+        print "ERROR: HTML parse error."
+        return None
+
+
 def parseHTML(metas):
-    new_metas = copy.deepcopy(metas)
+    # The metas are changed in place and returned.
+    parser = html()
     for cpage in metas:
         for html_part in metas[cpage]["html"]:
-            # page_html = html_part.get_payload(decode=True)
-            parser = html()
-            try:
-                parser.feed(html_part)
-            except:
-                print "ERROR: HTML parse error."
-            else:
-                parser.close()  # force processing all data
-                new_metas[cpage]["text"].add(parser.get_plaintext())
-    return new_metas
+            text = htmlText(html_part, parser)
+            if text is not None:
+                metas[cpage]["text"].add(text)
+    return metas
 
 
-def parseMetaData(metas):
-    # new_metas = Metas()
-    new_metas = copy.deepcopy(metas)
-    gtlt = re.compile('[<>]')
-    for cpage in metas:
-        msg = metas[cpage]['msg'].single()
-        tos = msg.get_all('to', [])
-        ccs = msg.get_all('cc', [])
-        resent_tos = msg.get_all('resent-to', [])
-        resent_ccs = msg.get_all('resent-cc', [])
-        all_recipients = getaddresses(tos + ccs + resent_tos + resent_ccs)
-        for r in all_recipients:
-            new_metas[cpage]["Recipient"].add(r[1])
-        reply_to = msg.get_all('reply-to', [])
-        if reply_to:
-            new_metas[cpage]["Sender"].add(reply_to[0])
-        msg_from = msg.get_all('from', []).pop()
-        new_metas[cpage]["From"].add(msg_from)
-        date = msg.get_all('date', []).pop()
-        new_metas[cpage]["Date"].add(date)
-        subject = msg.get_all('subject', []).pop()
+_gtlt = re.compile('[<>]')
+
+
+def _lastHeader(msg, name):
+    # The last of the named headers, or None
+    values = msg.get_all(name, [])
+    if values:
+        return values[-1]
+    return None
+
+
+def headerMetas(meta, msg):
+    tos = msg.get_all('to', [])
+    ccs = msg.get_all('cc', [])
+    resent_tos = msg.get_all('resent-to', [])
+    resent_ccs = msg.get_all('resent-cc', [])
+    all_recipients = getaddresses(tos + ccs + resent_tos + resent_ccs)
+    for r in all_recipients:
+        meta["Recipient"].add(r[1])
+    reply_to = msg.get_all('reply-to', [])
+    if reply_to:
+        meta["Sender"].add(reply_to[0])
+    msg_from = _lastHeader(msg, 'from')
+    if msg_from is not None:
+        meta["From"].add(msg_from)
+    date = _lastHeader(msg, 'date')
+    if date is not None:
+        meta["Date"].add(date)
+    subject = _lastHeader(msg, 'subject')
+    if subject is not None:
         subject = email.Header.decode_header(subject).pop()
         if subject[1] is not None:
             subject = unicode(subject[0], subject[1])
         else:
             subject = unicode(subject[0], 'utf-8')
-        new_metas[cpage]["Subject"].add(subject)
-        rpath = msg.get_all('return-path', []).pop()
-        rpath = gtlt.sub('', rpath)
-        new_metas[cpage]["Return-Path"].add(rpath)
-        msgid = msg.get_all('message-id', []).pop()
-        msgid = gtlt.sub('', msgid)
-        new_metas[cpage]["Message-ID"].add(msgid)
-    return new_metas
+        meta["Subject"].add(subject)
+    rpath = _lastHeader(msg, 'return-path')
+    if rpath is not None:
+        meta["Return-Path"].add(_gtlt.sub('', rpath))
+    msgid = _lastHeader(msg, 'message-id')
+    if msgid is not None:
+        meta["Message-ID"].add(_gtlt.sub('', msgid))
+
+
+def parseMetaData(metas):
+    # The metas are changed in place and returned.
+    for cpage in metas:
+        msg = metas[cpage]['msg'].single()
+        headerMetas(metas[cpage], msg)
+    return metas
 
 
 def getRrType(rr):
@@ -237,33 +513,36 @@ def getRrType(rr):
     return type
 
 
+_href = re.compile('(href|HREF|src|SRC|title)=(3D)?')
+_quote = re.compile('[\'\"]')
+_tag = re.compile('[<>]')
+
+
+def urlMetas(metas, cpage, content):
+    # Add the URLs in the raw content of a text part to the message
+    # page cpage, and the hosts of the URLs as pages of their own.
+    for token in content.split():
+        if url_all_re.search(token):
+            match = fqdn_re.search(token)
+            rr = match.group()
+            type = getRrType(rr)
+            metas[cpage]["SPAM RR"].add('[[%s]]' % rr)
+            metas[rr]["TYPE"].add(type)
+            token = _href.sub(' ', token)
+            token = _quote.sub(' ', token)
+            token = _tag.sub(' ', token)
+            url = token.split()
+            for i in url:
+                if url_all_re.search(i):
+                    metas[cpage]["SPAM URL"].add(i)
+
+
 def parseURLs(metas):
-    new_metas = copy.deepcopy(metas)
-    href = re.compile('(href|HREF|src|SRC|title)=(3D)?')
-    schema = re.compile('xmlns(:\w)?=')
-    quote = re.compile('[\'\"]')
-    tag = re.compile('[<>]')
-    for cpage in metas:
-        msg = metas[cpage]["msg"].single()
-        for part in msg.walk():
-            ctype = part.get_content_type()
-            if(ctype == "text/plain") or (ctype == "text/html"):
-                content = part.get_payload(decode=True)
-                tokens = content.split()
-                for token in tokens:
-                    if schema.search(token):
-                        pass
-                    if url_all_re.search(token):
-                        match = fqdn_re.search(token)
-                        rr = match.group()
-                        type = getRrType(rr)
-                        new_metas[cpage]["SPAM RR"].add('[[%s]]' % match.group())
-                        new_metas[rr]["TYPE"].add(type)
-                        token = href.sub(' ', token)
-                        token = quote.sub(' ', token)
-                        token = tag.sub(' ', token)
-                        url = token.split()
-                        for i in url:
-                            if url_all_re.search(i):
-                                new_metas[cpage]["SPAM URL"].add(i)
-    return new_metas
+    # The metas are changed in place and returned.
+    for cpage in metas.keys():
+        for msg in metas[cpage]["msg"]:
+            for part in msg.walk():
+                ctype = part.get_content_type()
+                if(ctype == "text/plain") or (ctype == "text/html"):
+                    urlMetas(metas, cpage, part.get_payload(decode=True))
+    return metas
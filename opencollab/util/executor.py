@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import Queue
+import itertools
+import threading
+import collections
+
+
+class Future(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._excinfo = None
+
+    def _set(self, result, excinfo):
+        self._result = result
+        self._excinfo = excinfo
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("result not ready in time")
+        if self._excinfo is not None:
+            type, value, traceback = self._excinfo
+            raise type, value, traceback
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("result not ready in time")
+        if self._excinfo is None:
+            return None
+        return self._excinfo[1]
+
+
+class Executor(object):
+    """
+    A small thread pool for running wiki calls concurrently. At most
+    maxPending tasks are in flight at a time: submit() blocks until
+    a slot frees up. map() delivers results in input order.
+
+    >>> with Executor(workers=3, maxPending=4) as executor:
+    ...     list(executor.map(lambda x: x * x, range(10)))
+    [0, 1, 4, 9, 16, 25, 36, 49, 64, 81]
+    """
+
+    def __init__(self, workers=4, maxPending=None):
+        if maxPending is None:
+            maxPending = 2 * workers
+
+        self.workers = workers
+        self.maxPending = maxPending
+
+        self._slots = threading.Semaphore(maxPending)
+        self._tasks = Queue.Queue()
+        self._threads = list()
+        self._closed = False
+
+        for _ in range(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+
+            future, func, args, keys = task
+            try:
+                result = func(*args, **keys)
+            except BaseException:
+                future._set(None, sys.exc_info())
+            else:
+                future._set(result, None)
+            finally:
+                self._slots.release()
+
+    def submit(self, func, *args, **keys):
+        if self._closed:
+            raise RuntimeError("executor has been shut down")
+
+        self._slots.acquire()
+        future = Future()
+        self._tasks.put((future, func, args, keys))
+        return future
+
+    def map(self, func, *iterables):
+        pending = collections.deque()
+
+        for args in itertools.izip(*iterables):
+            if len(pending) >= self.maxPending:
+                yield pending.popleft().result()
+            pending.append(self.submit(func, *args))
+
+        while pending:
+            yield pending.popleft().result()
+
+    def shutdown(self, wait=True):
+        if self._closed:
+            return
+        self._closed = True
+
+        for _ in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        return False
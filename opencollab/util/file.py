@@ -5,6 +5,7 @@
 """
 import os
 import sys
+import mmap
 import cStringIO
 
 
@@ -19,20 +20,238 @@ def md5obj(data=''):
     return md5.new(data)
 
 
+BLOCK_SIZE = 1024 * 1024
+
+# Suffix of the hidden files caching per-chunk digests next to the
+# hashed files, see chunkDigests.
+DIGEST_SUFFIX = ".opencollab-digests"
+
+
+def mapFile(fobj):
+    """
+    Return a read-only memory map of a real file object, or None if
+    the object can not be mapped (e.g. StringIO objects, pipes and
+    empty files).
+    """
+    try:
+        fileno = fobj.fileno()
+    except (AttributeError, IOError):
+        return None
+
+    try:
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError, mmap.error):
+        return None
+
+
 def hashFile(f):
     """
-    Expect a file name or a cStringIO.StringIO object.
+    Expect a file name or a file-like object (e.g. a cStringIO.StringIO
+    object). Real files are hashed through a memory map, other
+    objects a block at a time.
     """
     try:
-        data = f.read()
+        read = f.read
     except AttributeError:
-        fobj = file(f, 'rb')
-        data = fobj.read()
+        fobj = open(f, 'rb')
+        try:
+            return hashFile(fobj)
+        finally:
+            fobj.close()
+
+    mapped = mapFile(f)
+    if mapped is not None:
+        try:
+            return md5obj(mapped).hexdigest()
+        finally:
+            mapped.close()
+
+    digest = md5obj()
+    while True:
+        data = read(BLOCK_SIZE)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def hashChunks(fobj, chunkSize):
+    """
+    Return the MD5 digests of the chunkSize sized chunks of a file
+    object, reading real files through a memory map.
+
+    >>> hashChunks(cStringIO.StringIO("abc"), 2)
+    ['187ef4436122d1cc2f40dc2b92f0eba0', '4a8a08f09d37b73795649038408b5f33']
+    """
+    digests = list()
+
+    mapped = mapFile(fobj)
+    if mapped is not None:
+        try:
+            for offset in xrange(0, len(mapped), chunkSize):
+                chunk = buffer(mapped, offset, chunkSize)
+                digests.append(md5obj(chunk).hexdigest())
+        finally:
+            mapped.close()
+        return digests
+
+    while True:
+        data = fobj.read(chunkSize)
+        if not data:
+            break
+        digests.append(md5obj(data).hexdigest())
+    return digests
+
+
+def digestCachePath(path):
+    directory, name = os.path.split(path)
+    return os.path.join(directory, "." + name + DIGEST_SUFFIX)
+
+
+def isDigestCache(path):
+    _, name = os.path.split(path)
+    return name.startswith(".") and name.endswith(DIGEST_SUFFIX)
+
+
+def _readDigestCache(cachePath, key):
+    try:
+        cache = open(cachePath, "rb")
+    except IOError:
+        return None
+
+    try:
+        lines = cache.read().split()
+    finally:
+        cache.close()
+
+    if lines[:len(key)] != key:
+        return None
+    return lines[len(key):]
+
+
+def _writeDigestCache(cachePath, key, digests):
+    # The cache is only an optimisation, so e.g. read-only
+    # directories are not an error.
+    try:
+        cache = open(cachePath, "wb")
+        try:
+            cache.write("\n".join(key + digests) + "\n")
+        finally:
+            cache.close()
+    except IOError:
+        pass
+
+
+def chunkDigests(path, chunkSize, cache=True):
+    """
+    Return the MD5 digests of the chunkSize sized chunks of the file
+    in path. With cache=True the digests are also stored next to the
+    file, keyed by the file size, mtime and chunk size, and reused
+    as long as the file stays unchanged.
+    """
+    stat = os.stat(path)
+    key = ["%d" % stat.st_size, repr(stat.st_mtime), "%d" % chunkSize]
+    cachePath = digestCachePath(path)
+
+    if cache:
+        digests = _readDigestCache(cachePath, key)
+        if digests is not None:
+            return digests
+
+    fobj = open(path, "rb")
+    try:
+        digests = hashChunks(fobj, chunkSize)
+    finally:
         fobj.close()
-    return md5obj(data).hexdigest()
 
+    if cache:
+        _writeDigestCache(cachePath, key, digests)
+    return digests
+
+
+class DownloadJournal(object):
+    # Records the completed ranges of a download in a hidden file next
+    # to the downloaded file. The journal is only valid for the same
+    # remote digest, size and chunk size it was started with.
+
+    SUFFIX = ".opencollab-journal"
+
+    def __init__(self, path, digest, size, chunkSize):
+        directory, name = os.path.split(path)
+        self.path = os.path.join(directory, "." + name + self.SUFFIX)
+        self.key = [digest, "%d" % size, "%d" % chunkSize]
+        self.done = self._load()
+        self._file = None
+
+    def _load(self):
+        try:
+            journal = open(self.path, "rb")
+        except IOError:
+            return set()
+
+        try:
+            lines = journal.read().split("\n")
+        finally:
+            journal.close()
+
+        if lines[:len(self.key)] != self.key:
+            return set()
 
-def uploadFile(collab, page_name, file, file_name, progress=False, data=None):
+        done = set()
+        for line in lines[len(self.key):]:
+            # Skip a possibly half-written last line
+            try:
+                done.add(int(line))
+            except ValueError:
+                continue
+        return done
+
+    def open(self):
+        if self.done:
+            self._file = open(self.path, "ab")
+        else:
+            self._file = open(self.path, "wb")
+            self._file.write("\n".join(self.key) + "\n")
+            self._file.flush()
+
+    def record(self, offset):
+        self.done.add(offset)
+        self._file.write("%d\n" % offset)
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        self.done.clear()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def _attached(collab, page_name, file_name, digest, size):
+    # Whether the wiki still has the attachment with the given
+    # content, checked with one small call.
+    try:
+        info = collab.getAttachmentInfo(page_name, file_name)
+    except Exception:
+        return False
+    return list(info) == [digest, size]
+
+
+def uploadFile(collab, page_name, file, file_name, progress=False, data=None,
+               workers=1, cacheDigests=False, index=None, chunksPerCheck=10):
+    # The file is sent with putAttachmentChunked, with the given
+    # workers and chunksPerCheck (None to adapt, so that more than
+    # ten workers can be kept busy). With an AttachmentIndex (see
+    # opencollab.util.cache) a file already uploaded as the same
+    # attachment is not sent again, and a small file never seen on
+    # the page is sent without asking the wiki for a reassembly
+    # first.
     if file and data:
         raise RuntimeError("Parameter error: Both file and data specified!")
 
@@ -56,8 +275,39 @@ def uploadFile(collab, page_name, file, file_name, progress=False, data=None):
             except RuntimeError, msg:
                 raise RuntimeError(msg)
 
+    chunkSize = collab.DEFAULT_CHUNK
+    digests = None
+    if cacheDigests and hasattr(file_obj, "fileno"):
+        digests = chunkDigests(file_obj.name, chunkSize)
+
+    probe = True
+    if index is not None:
+        digest = hashFile(file_obj)
+        file_obj.seek(0, os.SEEK_END)
+        size = file_obj.tell()
+        file_obj.seek(0)
+
+        if index.find(page_name, file_name) == (digest, size) and \
+                _attached(collab, page_name, file_name, digest, size):
+            if progress:
+                sys.stdout.write("NOTE: Already uploaded %s\n" % file_name)
+                sys.stdout.flush()
+            file_obj.close()
+            return False
+
+        if digests is None:
+            digests = index.chunks(digest, size, chunkSize)
+        if digests is None:
+            digests = hashChunks(file_obj, chunkSize)
+            file_obj.seek(0)
+        probe = size > chunkSize or index.cached(page_name, digest, size)
+
     parts_uploaded = False
-    for current, total in collab.putAttachmentChunked(page_name, file_name, file_obj):
+    chunks = collab.putAttachmentChunked(page_name, file_name, file_obj,
+                                         chunksPerCheck=chunksPerCheck,
+                                         workers=workers, digests=digests,
+                                         probe=probe)
+    for current, total in chunks:
         percent = 100.0 * current / float(max(total, 1))
         status = current, total, percent
         if progress:
@@ -72,6 +322,9 @@ def uploadFile(collab, page_name, file, file_name, progress=False, data=None):
             sys.stdout.write("NOTE: Already uploaded %s\n" % file_name)
     sys.stdout.flush()
     file_obj.close()
+
+    if index is not None:
+        index.add(page_name, file_name, digest, size, chunkSize, digests)
     return parts_uploaded
 
 
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+
+
+class Manifest(object):
+    """
+    A persistent record of downloaded attachments. For each page and
+    attachment it keeps the local file path together with the size,
+    mtime and MD5 digest the file had when it was last hashed or
+    downloaded, so that unchanged files need not be hashed again.
+
+    >>> manifest = Manifest(":memory:")
+    >>> manifest.localDigest(u"Page", u"file.txt", __file__) is None
+    True
+    >>> manifest.record(u"Page", u"file.txt", __file__, "0123")
+    >>> manifest.localDigest(u"Page", u"file.txt", __file__)
+    u'0123'
+    >>> manifest.close()
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        page TEXT NOT NULL,
+        attachment TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        digest TEXT NOT NULL,
+        PRIMARY KEY (page, attachment)
+    )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute(self.SCHEMA)
+
+    def _decode(self, value):
+        if isinstance(value, str):
+            return value.decode("utf-8", "replace")
+        return value
+
+    def localDigest(self, page, attachment, path):
+        """
+        Return the recorded digest of the local file, or None if the
+        file has not been recorded or has changed since.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        row = self.db.execute("SELECT path, size, mtime, digest FROM files " +
+                              "WHERE page = ? AND attachment = ?",
+                              (self._decode(page),
+                               self._decode(attachment))).fetchone()
+        if row is None:
+            return None
+
+        recordedPath, size, mtime, digest = row
+        if recordedPath != self._decode(os.path.abspath(path)):
+            return None
+        if size != stat.st_size or mtime != stat.st_mtime:
+            return None
+        return digest
+
+    def record(self, page, attachment, path, digest):
+        stat = os.stat(path)
+        self.db.execute("INSERT OR REPLACE INTO files " +
+                        "(page, attachment, path, size, mtime, digest) " +
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (self._decode(page),
+                         self._decode(attachment),
+                         self._decode(os.path.abspath(path)),
+                         stat.st_size,
+                         stat.st_mtime,
+                         digest))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import Queue
+import threading
+import collections
+
+from opencollab.meta import Meta, Metas
+from opencollab.util.file import uploadFile
+
+# Marks the end of the items in a stage queue
+_END = object()
+
+
+class Attachment(object):
+    # A file to be attached to a page, given either as a path or as
+    # the data itself (see uploadFile).
+
+    def __init__(self, page, name, file=None, data=None):
+        self.page = page
+        self.name = name
+        self.file = file
+        self.data = data
+
+
+def decorate(category=None, template=None, audit=None):
+    """
+    Return a transform that gives the pages of Metas items the
+    category and template, unless they already have one, and tags
+    them with the audit name.
+
+    >>> metas = Metas()
+    >>> metas["a"]["gwikicategory"].add("CategoryScan")
+    >>> metas["b"]["TYPE"].add("NAME")
+    >>> metas = decorate("CategoryIdentity", audit="audit")(metas)
+    >>> sorted(metas["a"]["gwikicategory"]), sorted(metas["b"]["gwikicategory"])
+    (['CategoryScan'], ['CategoryIdentity'])
+    >>> sorted(metas["b"]["Audit"])
+    ['audit']
+    """
+
+    def transform(item):
+        if isinstance(item, Attachment):
+            return item
+
+        for page in item:
+            meta = item[page]
+            if category is not None and 'gwikicategory' not in meta:
+                meta["gwikicategory"].add(category)
+            if template is not None and 'gwikitemplate' not in meta:
+                meta["gwikitemplate"].add(template)
+            if audit is not None:
+                meta["Audit"].add(audit)
+        return item
+    return transform
+
+
+class StageStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.depthSum = 0
+        self.depthMax = 0
+        self.queued = False
+        self._lock = threading.Lock()
+
+    def done(self, items, busy, depth=None):
+        with self._lock:
+            self.items += items
+            self.busy += busy
+            if depth is not None:
+                self.queued = True
+                self.depthSum += depth
+                self.depthMax = max(self.depthMax, depth)
+
+    def throughput(self):
+        return self.items / max(self.busy, 1e-9)
+
+    def depth(self):
+        return float(self.depthSum) / max(self.items, 1)
+
+    def __str__(self):
+        line = "%-9s %8d items %8.1f s busy %10.1f items/s" % \
+            (self.name, self.items, self.busy, self.throughput())
+        if self.queued:
+            line += " queue depth %.1f avg %d max" % (self.depth(),
+                                                      self.depthMax)
+        return line
+
+
+class PipelineStats(object):
+    def __init__(self, names):
+        self.stages = collections.OrderedDict((name, StageStats(name))
+                                              for name in names)
+        self.elapsed = 0.0
+
+    def __getitem__(self, name):
+        return self.stages[name]
+
+    def __str__(self):
+        lines = [str(stage) for stage in self.stages.itervalues()]
+        lines.append("total %.1f s" % self.elapsed)
+        return "\n".join(lines)
+
+
+class Pipeline(object):
+    """
+    Moves parsed results to the wiki while the parser is still
+    running. The items given to run() go through four stages, each
+    reading from a bounded queue filled by the one before it:
+
+    - source: the calling thread iterates the given items, which are
+      Metas or Attachment instances.
+    - transform: each item is passed through the transform functions
+      in turn. A function may return a new item, or None to drop it.
+    - batch: Metas are merged into batches of batchSize items, each
+      sent with one incSetMeta call. Attachments are passed on as
+      they are.
+    - upload: the given number of worker threads send the batches
+      with incSetMeta and the attachments with uploadFile, side by
+      side.
+
+    An AttachmentIndex given as index is passed on to uploadFile.
+
+    When clear is given, those keys are cleared from each page the
+    first time the page is sent. A batch that comes back to an
+    already cleared page is sent only after the clearing batch, so
+    that its values are not cleared away.
+
+    >>> class Wiki(object):
+    ...     def __init__(self):
+    ...         self.calls = list()
+    ...     def incSetMeta(self, cleared, discarded, added):
+    ...         self.calls.append((sorted(cleared), sorted(added)))
+    >>> def hosts():
+    ...     for name in "abc":
+    ...         metas = Metas()
+    ...         metas[name]["TYPE"].add(u"IPv4")
+    ...         metas["Run"]["host"].add(name)
+    ...         yield metas
+    >>> wiki = Wiki()
+    >>> stats = Pipeline(wiki, batchSize=2, clear=["TYPE"]).run(hosts())
+    >>> wiki.calls[0]
+    (['Run', 'a', 'b'], ['Run', 'a', 'b'])
+    >>> wiki.calls[1]
+    (['c'], ['Run', 'c'])
+    >>> stats["batch"].items, stats["upload"].items
+    (3, 2)
+    """
+
+    STAGES = "source", "transform", "batch", "upload"
+
+    def __init__(self, collab, transforms=(), batchSize=500, workers=1,
+                 queueSize=4, clear=None, progress=False, index=None):
+        self.collab = collab
+        self.transforms = list(transforms)
+        self.batchSize = batchSize
+        self.workers = workers
+        self.queueSize = queueSize
+        self.clear = clear
+        self.progress = progress
+        self.index = index
+
+        self.stats = None
+        self._error = None
+        self._errorLock = threading.Lock()
+
+    def _fail(self):
+        # Remember the first error. The stages keep draining their
+        # queues without doing any more work (see _stage), so that
+        # nothing blocks.
+        with self._errorLock:
+            if self._error is None:
+                self._error = sys.exc_info()
+
+    def _stage(self, name, queue, handle, outputs):
+        # Run handle(item) on the items of a queue until its end
+        # mark, then pass the mark on to the output queues.
+        stats = self.stats[name]
+        while True:
+            depth = queue.qsize()
+            item = queue.get()
+            if item is _END:
+                break
+
+            start = time.time()
+            try:
+                handle(item)
+            except Exception:
+                self._fail()
+            stats.done(1, time.time() - start, depth)
+
+        for output in outputs:
+            output.put(_END)
+
+    def _transform(self, item, output):
+        if self._error is not None:
+            return
+
+        for transform in self.transforms:
+            item = transform(item)
+            if item is None:
+                return
+        output.put(item)
+
+    def _batch(self, item, output):
+        if self._error is not None:
+            return
+
+        if isinstance(item, Attachment):
+            output.put(item)
+            return
+
+        for page, meta in item.iteritems():
+            for key, values in meta.iteritems():
+                self._metas[page][key].update(values)
+        self._items += 1
+        if self._items >= self.batchSize:
+            self._flush(output)
+
+    def _flush(self, output):
+        metas = self._metas
+        self._metas = Metas()
+        self._items = 0
+        if not metas:
+            return
+
+        cleared = Meta()
+        after = set()
+        done = threading.Event()
+        if self.clear is not None:
+            for page in metas:
+                event = self._cleared.get(page, None)
+                if event is None:
+                    cleared[page] = self.clear
+                    self._cleared[page] = done
+                elif not event.is_set():
+                    after.add(event)
+        output.put((cleared, metas, after, done))
+
+    def _upload(self, task):
+        if isinstance(task, Attachment):
+            if self._error is None:
+                uploadFile(self.collab, task.page, task.file, task.name,
+                           self.progress, task.data, index=self.index)
+            return
+
+        # Batches waiting for this one are released even when it is
+        # skipped or fails.
+        cleared, metas, after, done = task
+        try:
+            for event in after:
+                event.wait()
+            if self._error is None:
+                self.collab.incSetMeta(cleared, Metas(), metas)
+        finally:
+            done.set()
+
+    def run(self, items):
+        """
+        Send the given items to the wiki and return PipelineStats once
+        everything has been sent. The first error raised by any stage
+        is raised here, after the stages have stopped.
+        """
+        self.stats = PipelineStats(self.STAGES)
+        self._error = None
+        self._metas = Metas()
+        self._items = 0
+        self._cleared = dict()
+
+        transformQueue = Queue.Queue(self.queueSize)
+        batchQueue = Queue.Queue(self.queueSize)
+        uploadQueue = Queue.Queue(self.queueSize)
+
+        def batch():
+            self._stage("batch", batchQueue,
+                        lambda item: self._batch(item, uploadQueue), [])
+            try:
+                if self._error is None:
+                    self._flush(uploadQueue)
+            except Exception:
+                self._fail()
+            for _ in range(self.workers):
+                uploadQueue.put(_END)
+
+        stages = [(self._stage, ("transform", transformQueue,
+                                 lambda item: self._transform(item,
+                                                              batchQueue),
+                                 [batchQueue])),
+                  (batch, ())]
+        stages.extend((self._stage, ("upload", uploadQueue, self._upload,
+                                     []))
+                      for _ in range(self.workers))
+
+        threads = list()
+        for target, args in stages:
+            thread = threading.Thread(target=target, args=args)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        start = time.time()
+        stats = self.stats["source"]
+        try:
+            items = iter(items)
+            while self._error is None:
+                before = time.time()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                stats.done(1, time.time() - before)
+                transformQueue.put(item)
+        except BaseException:
+            # Also an exit or interrupt from the source, so that the
+            # stages are stopped before it is raised again below
+            self._fail()
+        finally:
+            transformQueue.put(_END)
+            for thread in threads:
+                thread.join()
+            self.stats.elapsed = time.time() - start
+
+        if self._error is not None:
+            type, value, traceback = self._error
+            raise type, value, traceback
+        return self.stats
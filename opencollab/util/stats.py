@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from opencollab.wiki import RequestHook
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+           1.0, 2.0, 5.0, 10.0, 30.0)
+
+BAR_WIDTH = 40
+
+
+def formatBytes(amount):
+    """
+    >>> formatBytes(512), formatBytes(2048), formatBytes(3 * 1024 ** 2)
+    ('512 B', '2.0 KB', '3.0 MB')
+    """
+    if amount < 1024:
+        return "%d B" % amount
+    for unit in "KB", "MB":
+        amount /= 1024.0
+        if amount < 1024:
+            break
+    return "%.1f %s" % (amount, unit)
+
+
+def formatTime(seconds):
+    if seconds < 1.0:
+        return "%d ms" % round(seconds * 1000)
+    return "%.1f s" % seconds
+
+
+class MethodStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.dumps = 0.0
+        self.loads = 0.0
+        self.wall = 0.0
+        self.slowest = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def add(self, request):
+        self.calls += 1
+        if request.error is not None:
+            self.errors += 1
+        self.sent += request.sent
+        self.received += request.received
+        self.dumps += request.dumps
+        self.loads += request.loads
+        self.wall += request.wall
+        self.slowest = max(self.slowest, request.wall)
+
+        for index, bound in enumerate(BUCKETS):
+            if request.wall < bound:
+                break
+        else:
+            index = len(BUCKETS)
+        self.histogram[index] += 1
+
+    def __str__(self):
+        lines = ["%s: %d calls, %d errors, %s sent, %s received" %
+                 (self.name, self.calls, self.errors,
+                  formatBytes(self.sent), formatBytes(self.received))]
+
+        network = max(self.wall - self.dumps - self.loads, 0.0)
+        lines.append("  wall %s (avg %s, max %s), dumps %s, loads %s, "
+                     "network and server %s" %
+                     (formatTime(self.wall),
+                      formatTime(self.wall / max(self.calls, 1)),
+                      formatTime(self.slowest), formatTime(self.dumps),
+                      formatTime(self.loads), formatTime(network)))
+
+        # Leave out the empty buckets at both ends
+        used = [index for index, count in enumerate(self.histogram) if count]
+        most = max(self.histogram)
+        for index in range(used[0], used[-1] + 1):
+            if index < len(BUCKETS):
+                label = "< " + formatTime(BUCKETS[index])
+            else:
+                label = ">= " + formatTime(BUCKETS[-1])
+            count = self.histogram[index]
+            bar = "#" * int(round(BAR_WIDTH * count / float(most)))
+            lines.append(("    %-9s %7d %s" % (label, count, bar)).rstrip())
+        return "\n".join(lines)
+
+
+class RequestStats(RequestHook):
+    """
+    Collects the requests of a Wiki, when added as its hook, into a
+    latency histogram and totals per method. The report is the str()
+    of the instance.
+
+    >>> from opencollab.wiki import RequestInfo
+    >>> stats = RequestStats()
+    >>> for wall in 0.003, 0.004, 0.03:
+    ...     request = RequestInfo("GetMeta")
+    ...     request.start, request.wall = 100.0, wall
+    ...     request.sent, request.received = 300, 5000
+    ...     stats.after(request)
+    >>> stats.reconnect(request, None)
+    >>> print stats
+    GetMeta: 3 calls, 0 errors, 900 B sent, 14.6 KB received
+      wall 37 ms (avg 12 ms, max 30 ms), dumps 0 ms, loads 0 ms, network and server 37 ms
+        < 5 ms          2 ########################################
+        < 10 ms         0
+        < 20 ms         0
+        < 50 ms         1 ####################
+    total: 3 calls in 30 ms, 100.0 calls/s, 29.3 KB/s sent, 488.3 KB/s received
+    1 reconnects, 0 authentication refreshes
+    """
+
+    def __init__(self):
+        self.methods = dict()
+        self.reconnects = 0
+        self.reauths = 0
+        self.first = None
+        self.last = None
+        self._lock = threading.Lock()
+
+    def after(self, request):
+        with self._lock:
+            method = self.methods.get(request.name, None)
+            if method is None:
+                method = self.methods[request.name] = MethodStats(request.name)
+            method.add(request)
+
+            end = request.start + request.wall
+            if self.first is None or request.start < self.first:
+                self.first = request.start
+            if self.last is None or end > self.last:
+                self.last = end
+
+    def reconnect(self, request, error):
+        with self._lock:
+            self.reconnects += 1
+
+    def reauth(self, username):
+        with self._lock:
+            self.reauths += 1
+
+    def __str__(self):
+        with self._lock:
+            if not self.methods:
+                return "no requests"
+
+            methods = sorted(self.methods.values(),
+                             key=lambda method: -method.wall)
+            lines = [str(method) for method in methods]
+
+            calls = sum(method.calls for method in methods)
+            sent = sum(method.sent for method in methods)
+            received = sum(method.received for method in methods)
+            elapsed = max(self.last - self.first, 1e-9)
+            lines.append("total: %d calls in %s, %.1f calls/s, "
+                         "%s/s sent, %s/s received" %
+                         (calls, formatTime(elapsed), calls / elapsed,
+                          formatBytes(sent / elapsed),
+                          formatBytes(received / elapsed)))
+            lines.append("%d reconnects, %d authentication refreshes" %
+                         (self.reconnects, self.reauths))
+            return "\n".join(lines)
@@ -2,21 +2,258 @@
 
 import sys
 from opencollab.wiki import WikiFailure
-from opencollab.meta import Metas
+from opencollab.meta import Meta, Metas
+
+# Pages looked up per MetaTable search, and the limits of a single
+# IncSetMeta call.
+SEARCH_PAGES = 100
+DELTA_PAGES = 500
+DELTA_BYTES = 1024 * 1024
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode("utf-8", "replace")
+    return unicode(value)
+
+
+def _key(key):
+    # Categories are given as "category" to SetMeta, but stored and
+    # reported by GetMeta as "gwikicategory".
+    if key == "category":
+        return "gwikicategory"
+    return key
+
+
+def _searchable(page):
+    """
+    Whether MetaTable takes the page name as a page name, and not as
+    a list separator, a filter or a category.
+
+    >>> _searchable(u"FrontPage")
+    True
+    >>> [_searchable(page) for page in u"a, b", u"a=b", u"CategoryFoo"]
+    [False, False, False]
+    """
+    return ("," not in page and "=" not in page and
+            not page.startswith("Category"))
+
+
+class SyncResult(object):
+    def __init__(self):
+        self.pages = 0
+        self.skippedPages = 0
+        self.values = 0
+        self.skippedValues = 0
+        self.failed = list()
+
+    def __repr__(self):
+        return ("<SyncResult %d/%d pages and %d/%d values unchanged, " +
+                "%d pages failed>") % (self.skippedPages, self.pages,
+                                       self.skippedValues,
+                                       self.skippedValues + self.values,
+                                       len(self.failed))
+
+
+def currentMetas(collab, pages):
+    """
+    Return the current metas of the given pages, looked up with as
+    few MetaTable searches as possible. Pages missing from the result
+    do not exist or have no metas, or their metas are unknown: pages
+    whose names can not be used in a search are left out, as are the
+    pages of failed searches.
+
+    >>> class Wiki(object):
+    ...     def batch(self):
+    ...         return self
+    ...     def getMeta(self, value):
+    ...         pass
+    ...     def execute(self):
+    ...         return [{u"P0": Meta()}, WikiFailure("search failed")]
+    >>> pages = [u"P%d" % number for number in range(SEARCH_PAGES + 1)]
+    >>> currentMetas(Wiki(), pages).keys()
+    [u'P0']
+    """
+    pages = [page for page in pages if _searchable(page)]
+
+    batch = collab.batch()
+    for start in range(0, len(pages), SEARCH_PAGES):
+        batch.getMeta(u", ".join(pages[start:start + SEARCH_PAGES]))
+
+    current = dict()
+    for result in batch.execute():
+        if not isinstance(result, WikiFailure):
+            current.update(result)
+
+    wanted = set(pages)
+    for page in current.keys():
+        if page not in wanted:
+            del current[page]
+    return current
+
+
+def _replaced(meta, replace):
+    # The keys whose values are to be replaced: all keys of the meta
+    # for replace=True, none for replace=False, or the listed keys.
+    if replace is True:
+        return set(map(_key, meta.keys()))
+    if not replace:
+        return set()
+    return set(map(_key, replace))
+
+
+def metaDelta(current, meta, replace=True):
+    """
+    Return the (discarded, added, skipped) meta changes that turn the
+    current meta of a page into the given one. Replaced keys (see
+    _replaced) get exactly the new values, even if there are none,
+    while new values are just added to the other keys. skipped is the
+    number of new values already in place.
+
+    >>> current = Meta()
+    >>> current["a"].update([u"1", u"2"])
+    >>> current["b"].add(u"x")
+    >>> meta = Meta()
+    >>> meta["a"].update([u"2", u"3"])
+    >>> meta["b"].add("x")
+    >>> discarded, added, skipped = metaDelta(current, meta)
+    >>> discarded, added, skipped
+    ({'a': [u'1']}, {'a': [u'3']}, 2)
+    >>> metaDelta(current, meta, replace=False)
+    ({}, {'a': [u'3']}, 2)
+    >>> metaDelta(current, Meta(), replace=["b"])
+    ({'b': [u'x']}, {}, 0)
+    """
+    if current is None:
+        current = Meta()
+
+    replaced = _replaced(meta, replace)
+    values = dict((key, dict()) for key in replaced)
+    for key, newValues in meta.iteritems():
+        texts = ((_text(value), value) for value in newValues)
+        values.setdefault(_key(key), dict()).update(texts)
+
+    discarded = dict()
+    added = dict()
+    skipped = 0
+    for key, new in values.iteritems():
+        old = dict((_text(value), value) for value in current[key])
+
+        adds = [new[text] for text in new if text not in old]
+        if adds:
+            added[key] = adds
+        skipped += len(new) - len(adds)
+
+        if key in replaced:
+            discards = [old[text] for text in old if text not in new]
+            if discards:
+                discarded[key] = discards
+
+    return discarded, added, skipped
+
+
+def _pageChanges(current, page, meta, replace):
+    """
+    Return the (cleared, discarded, added, skipped) changes that turn
+    the current meta of a page, if found, into the given one. When
+    the current meta is unknown, the keys to be replaced are cleared
+    and all the new values are sent, as the page may still have
+    metas that a search did not find.
+
+    >>> meta = Meta()
+    >>> meta["a"].add(u"2")
+    >>> _pageChanges({}, u"a=b", meta, ["a"])
+    (['a'], {}, {'a': [u'2']}, 0)
+    >>> current = {u"Page": Meta()}
+    >>> current[u"Page"]["a"].add(u"1")
+    >>> _pageChanges(current, u"Page", meta, ["a"])
+    ([], {'a': [u'1']}, {'a': [u'2']}, 0)
+    """
+    if not _searchable(page) or page not in current:
+        discarded, added, _ = metaDelta(None, meta, replace)
+        return list(_replaced(meta, replace)), discarded, added, 0
+
+    discarded, added, skipped = metaDelta(current[page], meta, replace)
+    return list(), discarded, added, skipped
+
+
+def syncMetas(collab, metas, template="", replace=True, verbose=False,
+              workers=1):
+    """
+    Bring the metas of the given pages up to date, sending only the
+    values that differ from those the wiki already has. replace is
+    True to replace the values of all given keys, False to only add
+    values, or a list of the keys to replace. When a template is
+    given, the pages not found by the meta search (see currentMetas)
+    are set with setMeta and the template, so replace can then not be
+    a list of keys. The other changes are sent in IncSetMeta calls of
+    at most DELTA_PAGES pages and DELTA_BYTES bytes, by the given
+    number of workers. Returns a SyncResult.
+    """
+    if template and isinstance(replace, (list, tuple, set)):
+        # setMeta can only replace all the given keys or none
+        raise ValueError("a template can not be used with a list of " +
+                         "keys to replace")
+
+    result = SyncResult()
+
+    pages = metas.keys()
+    current = currentMetas(collab, pages)
+
+    batch = collab.batch()
+    created = list()
+    changes = dict(), dict(), dict()
+
+    for page in pages:
+        meta = metas[page]
+        result.pages += 1
+
+        if template and page not in current:
+            batch.setMeta(page, meta, bool(replace), template)
+            created.append(page)
+            result.values += sum(len(values) for values in meta.values())
+            continue
+
+        cleared, discarded, added, skipped = _pageChanges(current, page,
+                                                          meta, replace)
+        result.skippedValues += skipped
+        if not cleared and not discarded and not added:
+            result.skippedPages += 1
+            continue
+
+        result.values += len(cleared)
+        result.values += sum(len(values) for values in discarded.values())
+        result.values += sum(len(values) for values in added.values())
+
+        for pageChanges, values in zip(changes, (cleared, discarded, added)):
+            if values:
+                pageChanges[page] = values
+
+    for page, status in zip(created, batch.execute()):
+        if isinstance(status, WikiFailure):
+            print "ERROR:", page, status
+            result.failed.append(page)
+        elif verbose:
+            print page, status
+
+    if any(changes):
+        status = collab.incSetMeta(*changes, maxPages=DELTA_PAGES,
+                                   maxBytes=DELTA_BYTES, workers=workers)
+        for page, error in sorted(status.failed.items()):
+            print "ERROR:", page, error
+            result.failed.append(page)
+        if verbose:
+            print "NOTE:", status
+
+    return result
 
 
 def importMetas(collab, metas, template, verbose, replace=True):
-    failed = []
-    for page, pmeta in metas.iteritems():
-        try:
-            status = collab.setMeta(page, pmeta, template=template, replace=replace)
-        except WikiFailure, msg:
-            print "ERROR:", page, msg
-            failed.append(page)
-        else:
-            if verbose:
-                print page, status
-    return failed
+    result = syncMetas(collab, metas, template, replace, verbose=verbose)
+    if verbose:
+        print "NOTE: %d of %d pages and %d values already up to date." % \
+            (result.skippedPages, result.pages, result.skippedValues)
+    return result.failed
 
 
 def getPages(collab, search_string):
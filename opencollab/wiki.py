@@ -3,15 +3,21 @@
     @copyright: 2008 by Joachim Viide, Pekka Pietikäinen, Mika Seppänen
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
+import os
 import sys
 import errno
 import urllib
+import zlib
+import time
 import base64
 import socket
 import random
 import getpass
+import itertools
+import collections
 import urlparse
 import xmlrpclib
+import threading
 from encodings import idna
 
 import httplib
@@ -19,7 +25,9 @@ from httplib import HTTPConnection
 from _sslwrapper import HTTPSConnection
 
 from meta import Meta
-from util.file import md5obj
+from codec import FastCodec
+from util.file import md5obj, mapFile, hashFile, hashChunks, DownloadJournal
+from util.executor import Executor
 
 
 class WikiFailure(Exception):
@@ -50,12 +58,205 @@ class WikiFault(WikiFailure):
         self.fault = fault
 
 
+_MULTICALL_HEAD = ("<?xml version='1.0'?>\n" +
+                   "<methodCall>\n" +
+                   "<methodName>system.multicall</methodName>\n" +
+                   "<params>\n<param>\n" +
+                   "<value><array><data>\n")
+_MULTICALL_TAIL = ("</data></array></value>\n" +
+                   "</param>\n</params>\n" +
+                   "</methodCall>\n")
+
+
+def _fault(result):
+    # system.multicall reports faults as structs instead of
+    # single-item lists.
+    if not isinstance(result, dict):
+        return None
+    code = result.get("faultCode", None)
+    string = result.get("faultString", "<unknown fault>")
+    return xmlrpclib.Fault(code, string)
+
+
+class RequestInfo(object):
+    # What is known of one request to the wiki, as handed to the
+    # request hooks. Sizes are the bytes sent and received on the
+    # wire, times are in seconds. The dumps time includes compressing
+    # the body, and for streamed results the wall time runs until the
+    # last item has been consumed.
+
+    def __init__(self, name):
+        self.name = name
+        self.sent = 0
+        self.received = 0
+        self.dumps = 0.0
+        self.loads = 0.0
+        self.wall = 0.0
+        self.reconnects = 0
+        self.error = None
+        self.start = time.time()
+
+    def time(self, attr, func, *args):
+        # Call func(*args) and add the time it took to attr
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            setattr(self, attr, getattr(self, attr) + time.time() - start)
+
+    def finish(self):
+        self.wall = time.time() - self.start
+
+
+class RequestHook(object):
+    # Base class for the hooks added with Wiki.addHook. The methods
+    # are called in the thread making the request, so hooks shared by
+    # several threads need to do their own locking.
+
+    def before(self, request):
+        # The body is serialised and about to be sent.
+        pass
+
+    def after(self, request):
+        # The response has been parsed, or the request failed and
+        # request.error tells why.
+        pass
+
+    def reconnect(self, request, error):
+        # The keep-alive connection had been closed by the server
+        # (error), and the request is sent again on a fresh one.
+        pass
+
+    def reauth(self, username):
+        # The wiki rejected the authentication token, and a new one
+        # is being requested.
+        pass
+
+
+class ConnectionPool(object):
+    # Hands out keep-alive connections to one thread at a time. At
+    # most size connections are ever opened, and they are opened
+    # lazily as concurrent requests need them.
+
+    def __init__(self, connect, size=1):
+        self.connect = connect
+        self.size = size
+
+        self._idle = list()
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(size)
+
+    def get(self):
+        self._slots.acquire()
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+
+        try:
+            return self.connect()
+        except BaseException:
+            # Also on KeyboardInterrupt, so that the slot is not lost
+            self._slots.release()
+            raise
+
+    def put(self, connection):
+        with self._lock:
+            self._idle.append(connection)
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            for connection in self._idle:
+                connection.close()
+
+
+class _ItemUnmarshaller(object):
+    # Wraps a codec unmarshaller and takes the items of the result
+    # array out of its stack as soon as each of them has been decoded.
+    # The result array sits at depth 1, or at depth 3 when the call is
+    # wrapped in a system.multicall together with applyAuthToken.
+
+    def __init__(self, wiki, creds):
+        self.unmarshaller = unmarshaller = wiki.codec.unmarshaller()
+        self.start = unmarshaller.start
+        self.data = unmarshaller.data
+        self.xml = unmarshaller.xml
+        self.close = unmarshaller.close
+
+        self.wiki = wiki
+        self.creds = creds
+        self.items = collections.deque()
+
+        if creds is None:
+            self.depth = 1
+            self.checked = True
+        else:
+            self.depth = 3
+            self.checked = False
+
+    def end(self, tag):
+        self.unmarshaller.end(tag)
+        if tag != "array" and tag != "struct":
+            return
+
+        stack = self.unmarshaller._stack
+        depth = len(self.unmarshaller._marks)
+        if depth == self.depth:
+            self.items.append(stack.pop())
+            self.checked = True
+        elif not self.checked and depth == 1 and len(stack) == 1:
+            self.wiki._check_auth(stack[0])
+            self.checked = True
+
+
+def _compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.compressobj(6)
+    raise ValueError("unsupported content encoding %r" % encoding)
+
+
+def _decompressor(encoding):
+    encoding = encoding.strip().lower()
+    if encoding in ("", "identity"):
+        return None
+    if encoding in ("gzip", "x-gzip"):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    raise WikiFailure("unsupported content encoding %r" % encoding)
+
+
 class Wiki(object):
-    def __init__(self, url, ssl_verify_cert=True, ssl_ca_certs=None):
+    STREAM_BLOCK = 64 * 1024
+
+    # Request bodies smaller than this are not worth compressing.
+    COMPRESS_MIN = 1024
+
+    def __init__(self, url, ssl_verify_cert=True, ssl_ca_certs=None,
+                 connections=1, codec=None, compress=None, hooks=()):
         self.ssl_verify_cert = ssl_verify_cert
         self.ssl_ca_certs = ssl_ca_certs
 
+        # Responses are always accepted compressed. Compressing the
+        # request bodies as well requires support from the server, so
+        # it is enabled separately with compress="gzip" (or True) or
+        # compress="deflate".
+        if compress is True:
+            compress = "gzip"
+        elif not compress:
+            compress = None
+        else:
+            _compressor(compress)
+        self.compress = compress
+
+        if codec is None:
+            codec = FastCodec()
+        self.codec = codec
+
         scheme, host, path, _, _, _ = urlparse.urlparse(url)
+        self.scheme = scheme.strip().lower()
 
         if isinstance(host, unicode):
             host = idna.ToASCII(host)
@@ -65,21 +266,61 @@ class Wiki(object):
             path = path.encode("utf-8")
         self.path = urllib.quote(path) + "?action=xmlrpc2"
 
-        self.headers = dict(Connection="Keep-Alive")
+        self.headers = {
+            "Connection": "Keep-Alive",
+            "Accept-Encoding": "gzip, deflate"
+        }
         self.creds = None
-
-        if scheme.strip().lower() == "http":
-            self.connection = HTTPConnection(self.host)
+        self._authLock = threading.Lock()
+
+        # Replaced instead of modified, so that the requests running
+        # in other threads can iterate it without locking.
+        self.hooks = list(hooks)
+
+        # Open the first connection right away so that bad URLs are
+        # noticed already here.
+        self.pool = ConnectionPool(self._connect, connections)
+        self.connection = self.pool.get()
+        self.pool.put(self.connection)
+
+    def addHook(self, hook):
+        """
+        Have the RequestHook instance hook notified of each request.
+        """
+        self.hooks = self.hooks + [hook]
+
+    def removeHook(self, hook):
+        self.hooks = [other for other in self.hooks if other is not hook]
+
+    def _fire(self, event, *args):
+        for hook in self.hooks:
+            getattr(hook, event)(*args)
+
+    def _finish(self, request):
+        request.finish()
+        self._fire("after", request)
+
+    def _connect(self):
+        if self.scheme == "http":
+            connection = HTTPConnection(self.host)
         else:
-            self.connection = HTTPSConnection(self.host,
-                                              verify_cert=self.ssl_verify_cert,
-                                              ca_certs=self.ssl_ca_certs)
-        self.connection.connect()
+            connection = HTTPSConnection(self.host,
+                                         verify_cert=self.ssl_verify_cert,
+                                         ca_certs=self.ssl_ca_certs)
+        connection.connect()
+        return connection
 
     def _wiki_auth(self, username, password):
-        self.creds = None
+        # getAuthToken is called without the old token. The old
+        # credentials stay in place until the new token arrives, so
+        # that requests running in other threads are not affected.
+        token = None
+        try:
+            token = self._call(None, "getAuthToken", (username, password))
+        finally:
+            if not token:
+                self.creds = None
 
-        token = self._request("getAuthToken", username, password)
         if not token:
             raise WikiAuthenticationFailed("wiki authentication failed")
 
@@ -97,76 +338,258 @@ class Wiki(object):
             self.creds = None
             raise
 
-    def _dumps(self, name, args):
-        if self.creds is None:
-            return xmlrpclib.dumps(args, name, allow_none=True)
+    def _dumps(self, name, args, creds):
+        if creds is None:
+            return self.codec.dumps(args, name)
 
-        token, _, _ = self.creds
+        token, _, _ = creds
 
         mc_list = list()
         mc_list.append(dict(methodName="applyAuthToken", params=(token,)))
         mc_list.append(dict(methodName=name, params=args))
-        return xmlrpclib.dumps((mc_list,), "system.multicall", allow_none=True)
-
-    def _loads(self, data):
-        result, _ = xmlrpclib.loads(data)
-        if self.creds is None:
+        return self.codec.dumps((mc_list,), "system.multicall")
+
+    def _dumps_multicall(self, entries, creds):
+        head = list()
+        if creds is not None:
+            token, _, _ = creds
+            call = dict(methodName="applyAuthToken", params=(token,))
+            head.append(self.codec.marshal(call))
+        return "".join([_MULTICALL_HEAD] + head + entries + [_MULTICALL_TAIL])
+
+    def _check_auth(self, auth):
+        fault = _fault(auth)
+        if fault is None:
+            return
+        if fault.faultCode == "INVALID":
+            raise WikiAuthenticationFailed(fault.faultString)
+        raise fault
+
+    def _loads(self, chunks, creds):
+        result = self.codec.parse(chunks)
+        if creds is None:
             return result[0]
 
         auth, other = result[0]
+        self._check_auth(auth)
 
-        if isinstance(auth, dict):
-            code = auth.get("faultCode", None)
-            string = auth.get("faultString", "<unknown fault>")
-            if code == "INVALID":
-                raise WikiAuthenticationFailed(string)
-            raise xmlrpclib.Fault(code, string)
+        fault = _fault(other)
+        if fault is not None:
+            raise fault
+        return other[0]
 
-        if isinstance(other, dict):
-            code = other.get("faultCode", None)
-            string = other.get("faultString", "<unknown fault>")
-            raise xmlrpclib.Fault(code, string)
+    def _loads_multicall(self, chunks, creds):
+        results = self.codec.parse(chunks)[0]
 
-        return other[0]
+        if creds is not None:
+            self._check_auth(results.pop(0))
 
-    def _read_response(self, response):
-        data = response.read()
+        for index, other in enumerate(results):
+            fault = _fault(other)
+            if fault is None:
+                results[index] = other[0]
+            else:
+                results[index] = WikiFault(fault)
+        return results
+
+    def _iter_response(self, response, request):
+        # Yield the response body a block at a time, decompressing it
+        # on the way if needed.
         if response.status == 401:
+            response.read()
             raise HttpAuthenticationFailed(response.reason)
         elif response.status != 200:
+            response.read()
             raise WikiFailure(response.reason)
-        return self._loads(data)
 
-    def _request(self, name, *args):
-        body = self._dumps(name, args)
+        encoding = response.getheader("content-encoding", "")
+        decompressor = _decompressor(encoding)
+
+        while True:
+            data = response.read(self.STREAM_BLOCK)
+            if not data:
+                break
+            request.received += len(data)
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if data:
+                yield data
+
+        if decompressor is not None:
+            data = decompressor.flush()
+            if data:
+                yield data
+
+    def _read_response(self, response, request):
+        # Keep the body as a list of blocks, the codecs parse them one
+        # by one without joining them first.
+        return list(self._iter_response(response, request))
+
+    def _encode_body(self, body):
+        headers = self.headers
+        if self.compress is not None and len(body) >= self.COMPRESS_MIN:
+            compressor = _compressor(self.compress)
+            body = compressor.compress(body) + compressor.flush()
+
+            headers = dict(headers)
+            headers["Content-Encoding"] = self.compress
+        return body, headers
+
+    def _send(self, connection, body, request):
+        body, headers = request.time("dumps", self._encode_body, body)
+        request.sent = len(body)
+        self._fire("before", request)
+
         try:
-            self.connection.request("POST", self.path, body, self.headers)
-            response = self.connection.getresponse()
+            connection.request("POST", self.path, body, headers)
+            return connection.getresponse()
         except socket.error as error:
             if error.args[0] != errno.EPIPE:
                 raise
-        except httplib.BadStatusLine:
+        except httplib.BadStatusLine as error:
             pass
-        else:
-            return self._read_response(response)
 
-        self.connection.close()
-        self.connection.connect()
-        self.connection.request("POST", self.path, body, self.headers)
-        response = self.connection.getresponse()
-        return self._read_response(response)
+        request.reconnects += 1
+        self._fire("reconnect", request, error)
+        connection.close()
+        connection.connect()
+        connection.request("POST", self.path, body, headers)
+        return connection.getresponse()
 
-    def request(self, name, *args):
+    def _post_connection(self, connection, body, request):
+        response = self._send(connection, body, request)
+        return self._read_response(response, request)
+
+    def _post(self, body, request):
+        connection = self.pool.get()
+        try:
+            return self._post_connection(connection, body, request)
+        except BaseException:
+            # The connection may be left in the middle of a request,
+            # also when interrupted, so have httplib open a fresh one
+            # on the next use.
+            connection.close()
+            raise
+        finally:
+            self.pool.put(connection)
+
+    def _post_stream(self, body, request):
+        # Yield the response body a block at a time. The stream gets
+        # a connection of its own, outside the pool, so that other
+        # requests can be made while the response is being consumed.
+        connection = self._connect()
+        try:
+            response = self._send(connection, body, request)
+            for data in self._iter_response(response, request):
+                yield data
+        finally:
+            connection.close()
+
+    def _stream(self, name, *args):
+        # Start a call whose result is an array and return an iterator
+        # over its items, decoded one at a time as the response comes
+        # in. The authentication result is checked before returning,
+        # so that the call can still be retried.
+        creds = self.creds
+        request = RequestInfo(name)
+        try:
+            body = request.time("dumps", self._dumps, name, args, creds)
+
+            chunks = self._post_stream(body, request)
+            unmarshaller = _ItemUnmarshaller(self, creds)
+            parser = self.codec.parser(unmarshaller)
+
+            for chunk in chunks:
+                request.time("loads", parser.feed, chunk)
+                if unmarshaller.checked:
+                    break
+        except Exception as error:
+            request.error = error
+            self._finish(request)
+            raise
+
+        return self._iterItems(chunks, parser, unmarshaller, request)
+
+    def _iterItems(self, chunks, parser, unmarshaller, request):
+        try:
+            while True:
+                while unmarshaller.items:
+                    yield unmarshaller.items.popleft()
+
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                request.time("loads", parser.feed, chunk)
+
+            request.time("loads", parser.close)
+            result = request.time("loads", unmarshaller.close)
+            if unmarshaller.creds is not None:
+                _, other = result[0]
+                fault = _fault(other)
+                if fault is not None:
+                    raise fault
+        except Exception as error:
+            request.error = error
+            raise
+        finally:
+            chunks.close()
+            self._finish(request)
+
+    def _call(self, creds, name, args):
+        request = RequestInfo(name)
+        try:
+            body = request.time("dumps", self._dumps, name, args, creds)
+            chunks = self._post(body, request)
+            return request.time("loads", self._loads, chunks, creds)
+        except Exception as error:
+            request.error = error
+            raise
+        finally:
+            self._finish(request)
+
+    def _request(self, name, *args):
+        return self._call(self.creds, name, args)
+
+    def _multicall(self, entries):
+        creds = self.creds
+        request = RequestInfo("system.multicall")
+        try:
+            body = request.time("dumps", self._dumps_multicall, entries, creds)
+            chunks = self._post(body, request)
+            return request.time("loads", self._loads_multicall, chunks, creds)
+        except Exception as error:
+            request.error = error
+            raise
+        finally:
+            self._finish(request)
+
+    def _retry(self, func, *args):
         try:
             try:
-                return self._request(name, *args)
+                return func(*args)
             except WikiAuthenticationFailed:
-                _, username, password = self.creds
-                self._wiki_auth(username, password)
-                return self._request(name, *args)
+                with self._authLock:
+                    _, username, password = self.creds
+                    self._fire("reauth", username)
+                    self._wiki_auth(username, password)
+                return func(*args)
         except xmlrpclib.Fault, fault:
             raise WikiFault(fault)
 
+    def request(self, name, *args):
+        return self._retry(self._request, name, *args)
+
+    def batch(self, **keys):
+        return Batch(self, **keys)
+
+    def executor(self, workers=None, maxPending=None):
+        # Requests from the executor threads share the connection
+        # pool, so by default run as many workers as there are
+        # connections.
+        if workers is None:
+            workers = self.pool.size
+        return Executor(workers, maxPending)
+
     def authenticate(self, username, password):
         try:
             self._authenticate(username, password)
@@ -175,20 +598,215 @@ class Wiki(object):
         return True
 
 
+class Batch(object):
+    # Queues calls and sends them to the wiki as chunked
+    # system.multicall requests. A single request carries at most
+    # maxCalls calls and, unless one call alone is larger, at most
+    # maxBytes of marshalled call data. Results are collected to
+    # self.results in queuing order, and faults are stored there as
+    # WikiFault instances instead of being raised so that one failing
+    # call does not sink the rest of the batch.
+
+    DEFAULT_CALLS = 100
+    DEFAULT_BYTES = 1024 * 1024
+
+    def __init__(self, wiki, maxCalls=DEFAULT_CALLS, maxBytes=DEFAULT_BYTES):
+        self.wiki = wiki
+        self.maxCalls = maxCalls
+        self.maxBytes = maxBytes
+
+        self.results = list()
+        self._pending = list()
+        self._pendingBytes = 0
+
+    def _queue(self, name, args, convert=None):
+        entry = self.wiki.codec.marshal(dict(methodName=name, params=args))
+
+        if self._pending:
+            if len(self._pending) >= self.maxCalls:
+                self.flush()
+            elif self._pendingBytes + len(entry) > self.maxBytes:
+                self.flush()
+
+        self._pending.append((entry, convert))
+        self._pendingBytes += len(entry)
+        return len(self.results) + len(self._pending) - 1
+
+    def request(self, name, *args):
+        """
+        Queue a call and return its index in self.results.
+        """
+        return self._queue(name, args)
+
+    def flush(self):
+        if not self._pending:
+            return
+
+        entries = [entry for entry, _ in self._pending]
+        results = self.wiki._retry(self.wiki._multicall, entries)
+
+        for (_, convert), result in zip(self._pending, results):
+            if convert is not None and not isinstance(result, WikiFault):
+                result = convert(result)
+            self.results.append(result)
+
+        self._pending = list()
+        self._pendingBytes = 0
+
+    def execute(self):
+        self.flush()
+        return self.results
+
+    def __len__(self):
+        return len(self.results) + len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        return False
+
+
+def _rowMeta(keys, result):
+    # The result row is left as it is, as it may also be cached.
+    page, values = result[0], result[1:]
+    meta = Meta()
+
+    for key, values in zip(keys, values):
+        if not values:
+            continue
+        meta[key].update(values)
+
+    return page, meta
+
+
+def _parseMeta(results):
+    keys = results.pop(0)
+    pages = dict()
+
+    for result in results:
+        page, meta = _rowMeta(keys, result)
+        pages[page] = meta
+
+    return pages
+
+
+def _setMetaArgs(page, meta, replace, template):
+    if replace:
+        metaMode, categoryMode = "repl", "set"
+    else:
+        metaMode, categoryMode = "add", "add"
+
+    keys = dict()
+    for key, values in meta.iteritems():
+        keys[key] = list(values)
+
+    # If no categories specified, do not set categories to empty
+    if 'category' not in keys:
+        categoryMode = 'add'
+
+    categories = keys.pop("category", list())
+
+    return (page, keys, metaMode, True, categoryMode, categories, template)
+
+
+def _incSetMetaArgs(cleared, discarded, added):
+    clearedDict = dict()
+    for page, keys in cleared.iteritems():
+        clearedDict[page] = list(keys)
+
+    discardedDict = dict()
+    for page, meta in discarded.iteritems():
+        discardedDict[page] = dict()
+        for key, values in meta.iteritems():
+            discardedDict[page][key] = list(values)
+
+    addedDict = dict()
+    for page, meta in added.iteritems():
+        addedDict[page] = dict()
+        for key, values in meta.iteritems():
+            addedDict[page][key] = list(values)
+
+    return (clearedDict, discardedDict, addedDict)
+
+
+def _incSetMetaPages(cleared, discarded, added):
+    return set(cleared) | set(discarded) | set(added)
+
+
+class IncSetMetaResult(object):
+    # The consolidated result of an incSetMeta call split into
+    # batches. results holds the return value of each batch that got
+    # through, failed maps the pages of the other batches to the
+    # error of their last attempt. True if nothing failed.
+
+    def __init__(self):
+        self.batches = 0
+        self.retries = 0
+        self.results = list()
+        self.failed = dict()
+
+    def __nonzero__(self):
+        return not self.failed
+
+    def __repr__(self):
+        return "<IncSetMetaResult %d batches, %d retries, %d pages failed>" % \
+            (self.batches, self.retries, len(self.failed))
+
+
 class GraphingWiki(Wiki):
     DEFAULT_CHUNK = 256 * 1024
 
+    MIN_CHUNKS_PER_CHECK = 10
+    MAX_CHUNKS_PER_CHECK = 1000
+
+    def __init__(self, url, cache=None, **keys):
+        # An optional opencollab.util.cache.Cache for getPage,
+        # getPageHTML and getMeta results. Entries are invalidated
+        # when this client changes the pages.
+        self.cache = cache
+        super(GraphingWiki, self).__init__(url, **keys)
+
+    def _cached(self, method, page, name, *args):
+        if self.cache is None:
+            return self.request(name, *args)
+
+        key = (name,) + args
+        found, value = self.cache.get(method, key)
+        if not found:
+            generation = self.cache.generation
+            value = self.request(name, *args)
+            self.cache.put(method, key, value, page, generation)
+        return value
+
+    def _invalidate(self, *pages):
+        if self.cache is None:
+            return
+        for page in pages:
+            self.cache.invalidate(page)
+
+    def batch(self, **keys):
+        return GraphingBatch(self, **keys)
+
     def getPage(self, page):
-        return self.request("getPage", page)
+        return self._cached("getPage", page, "getPage", page)
 
     def getPageHTML(self, page):
-        return self.request("getPageHTML", page)
+        return self._cached("getPageHTML", page, "getPageHTML", page)
 
     def putPage(self, page, content):
-        return self.request("putPage", page, content)
+        try:
+            return self.request("putPage", page, content)
+        finally:
+            self._invalidate(page)
 
     def deletePage(self, page, comment=None):
-        return self.request("DeletePage", page, comment)
+        try:
+            return self.request("DeletePage", page, comment)
+        finally:
+            self._invalidate(page)
 
     def putCacheFile(self, page, filename, data, overwrite=False):
         data = xmlrpclib.Binary(data)
@@ -223,57 +841,115 @@ class GraphingWiki(Wiki):
     def getAttachmentInfo(self, page, filename):
         return self.request("ChunkedAttachFile", page, filename, "info")
 
-    def putAttachmentChunked(self, page, filename, seekableStream,
-                             chunksPerCheck=10, chunkSize=DEFAULT_CHUNK, log=True):
-        count = 0
-        total = 0
-        digests = list()
-        offsets = dict()
+    def _putChunk(self, page, digest, data):
+        try:
+            self.putCacheFile(page, digest, data, overwrite=True)
+        except WikiFailure, e:
+            if e.fault.faultString == 'No such method: PageCache.':
+                self.putAttachment(page, digest, data, overwrite=True, log=False)
+            else:
+                raise
 
-        while True:
-            data = seekableStream.read(chunkSize)
-            if not data:
-                break
+    def putAttachmentChunked(self, page, filename, seekableStream,
+                             chunksPerCheck=10, chunkSize=DEFAULT_CHUNK, log=True,
+                             workers=1, digests=None, probe=True):
+        # With workers > 1 that many chunks are uploaded concurrently
+        # through the connection pool (see the connections argument
+        # of Wiki). With chunksPerCheck=None the number of chunks sent
+        # between reassembly checks adapts: it doubles whenever the
+        # previous round was fully accepted and drops back otherwise.
+        # Chunk digests computed beforehand (see chunkDigests in
+        # opencollab.util.file) can be given to skip hashing here.
+        # With probe=False the chunks are known not to be in the page
+        # cache, so they are sent without asking for a reassembly
+        # first.
+        if digests is None:
+            digests = hashChunks(seekableStream, chunkSize)
+
+        # Real files are read through a memory map, which is also
+        # safe to share between the upload workers.
+        mapped = mapFile(seekableStream)
+        if mapped is None:
+            seekableStream.seek(0, os.SEEK_END)
+            total = seekableStream.tell()
+        else:
+            total = len(mapped)
 
-            digest = md5obj(data).hexdigest()
-            digests.append(digest)
+        offsets = dict()
+        for index, digest in enumerate(digests):
+            offset = index * chunkSize
+            offsets[digest] = offset, min(chunkSize, total - offset)
 
-            length = len(data)
-            offsets[digest] = total, length
-            total += length
+        adaptive = chunksPerCheck is None
+        if adaptive:
+            chunksPerCheck = max(workers, self.MIN_CHUNKS_PER_CHECK)
 
-        while True:
-            missing = self.request("ChunkedAttachFile", page, filename,
-                                   "reassembly", chunkSize, digests)
-            if not missing:
-                return
+        lock = threading.Lock()
 
-            done = total
-            for digest in missing:
-                offset, length = offsets[digest]
-                done -= length
+        def upload(digest):
+            offset, length = offsets[digest]
 
-            yield done, total
+            if mapped is not None:
+                data = mapped[offset:offset + length]
+            else:
+                with lock:
+                    seekableStream.seek(offset)
+                    data = seekableStream.read(length)
 
-            missing = random.sample(missing, min(len(missing), chunksPerCheck))
-            for digest in missing:
-                offset, length = offsets[digest]
+            self._putChunk(page, digest, data)
+            return length
 
-                seekableStream.seek(offset)
-                data = seekableStream.read(length)
+        executor = None
+        if workers > 1:
+            executor = self.executor(workers)
 
-                try:
-                    self.putCacheFile(page, digest, data, overwrite=True)
-                except WikiFailure, e:
-                    if e.fault.faultString == 'No such method: PageCache.':
-                        self.putAttachment(page, digest, data, overwrite=True, log=False)
+        try:
+            previous = None
+            sent = 0
+
+            while True:
+                if probe:
+                    missing = self.request("ChunkedAttachFile", page,
+                                           filename, "reassembly",
+                                           chunkSize, digests)
+                    if not missing:
+                        return
+                else:
+                    missing = sorted(offsets)
+                    probe = True
+
+                if adaptive and previous is not None:
+                    if previous - len(missing) >= sent:
+                        chunksPerCheck = min(2 * chunksPerCheck,
+                                             self.MAX_CHUNKS_PER_CHECK)
                     else:
-                        raise
+                        chunksPerCheck = max(workers, self.MIN_CHUNKS_PER_CHECK)
+
+                done = total
+                for digest in missing:
+                    offset, length = offsets[digest]
+                    done -= length
 
-                count += 1
-                done += length
                 yield done, total
 
+                previous = len(missing)
+                missing = random.sample(missing, min(len(missing), chunksPerCheck))
+                sent = len(missing)
+
+                if executor is None:
+                    lengths = itertools.imap(upload, missing)
+                else:
+                    lengths = executor.map(upload, missing)
+
+                for length in lengths:
+                    done += length
+                    yield done, total
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if mapped is not None:
+                mapped.close()
+
     def getAttachmentChunked(self, page, filename, chunkSize=DEFAULT_CHUNK):
         digest, size = self.getAttachmentInfo(page, filename)
 
@@ -301,64 +977,294 @@ class GraphingWiki(Wiki):
         if dataDigest != digest:
             raise WikiFailure("data changed while reading")
 
+    def getAttachmentToFile(self, page, filename, path,
+                            chunkSize=DEFAULT_CHUNK, workers=1, info=None):
+        # Download an attachment straight into the file in path,
+        # yielding (current, total) progress tuples. Ranges are written
+        # at their offsets in the preallocated file, so with workers > 1
+        # several ranges can be fetched concurrently. Completed ranges
+        # are recorded in a journal next to the file, and an
+        # interrupted download resumes where it left off. The whole
+        # file is checked against the attachment digest in the end.
+        # The (digest, size) pair can be given in info when it has
+        # already been fetched, e.g. in a batch.
+        if info is None:
+            info = self.getAttachmentInfo(page, filename)
+        digest, size = info
+
+        journal = DownloadJournal(path, digest, size, chunkSize)
+        if journal.done and os.path.exists(path):
+            output = open(path, "r+b")
+        else:
+            journal.done.clear()
+            output = open(path, "wb")
+        output.truncate(size)
+        journal.open()
+
+        def fetch(offset):
+            end = min(offset + chunkSize, size)
+            data = self.request("ChunkedAttachFile", page, filename, "load",
+                                offset, end)
+            data = str(data)
+            if len(data) != end - offset:
+                raise WikiFailure("data changed while reading")
+            return offset, data
+
+        offsets = list()
+        current = 0
+        for offset in xrange(0, size, chunkSize):
+            if offset in journal.done:
+                current += min(chunkSize, size - offset)
+            else:
+                offsets.append(offset)
+
+        executor = None
+        if workers > 1:
+            executor = self.executor(workers)
+
+        try:
+            yield current, size
+
+            if executor is None:
+                ranges = itertools.imap(fetch, offsets)
+            else:
+                ranges = executor.map(fetch, offsets)
+
+            for offset, data in ranges:
+                output.seek(offset)
+                output.write(data)
+                journal.record(offset)
+
+                current += len(data)
+                yield current, size
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            output.close()
+            journal.close()
+
+        if hashFile(path) != digest:
+            journal.remove()
+            raise WikiFailure("data changed while reading")
+        journal.remove()
+
     def getMeta(self, value):
         keysOnly = False
-        results = self.request("GetMeta", value, keysOnly)
+        results = self._cached("getMeta", None, "GetMeta", value, keysOnly)
+        return _parseMeta(results)
+
+    def iterMeta(self, value):
+        """
+        Like getMeta, but yield (page, meta) pairs one at a time as
+        the response is being parsed. With a cache, the whole result
+        is stored once read, unless pages were changed meanwhile.
+
+        >>> import socket
+        >>> from opencollab.util.cache import Cache
+        >>> server = socket.socket()
+        >>> server.bind(("127.0.0.1", 0))
+        >>> server.listen(1)
+        >>> url = "http://127.0.0.1:%d/" % server.getsockname()[1]
+        >>> collab = GraphingWiki(url, cache=Cache())
+        >>> collab._stream = lambda *args: iter([["key"], ["P1", ["1"]]])
+        >>> [(page, list(meta["key"])) for page, meta in collab.iterMeta("Cat")]
+        [('P1', ['1'])]
+        >>> list(collab.getMeta("Cat")["P1"]["key"])
+        ['1']
+        >>> [(page, list(meta["key"])) for page, meta in collab.iterMeta("Cat")]
+        [('P1', ['1'])]
+        >>> for page, meta in collab.iterMeta("Other"):
+        ...     collab._invalidate(page)
+        >>> collab.cache.get("getMeta", ("GetMeta", "Other", False))
+        (False, None)
+        >>> server.close()
+        """
+        keysOnly = False
 
-        keys = results.pop(0)
-        pages = dict()
+        if self.cache is not None:
+            key = ("GetMeta", value, keysOnly)
+            found, results = self.cache.get("getMeta", key)
+            if found:
+                keys = results[0]
+                for row in results[1:]:
+                    yield _rowMeta(keys, row)
+                return
 
-        for result in results:
-            page = result.pop(0)
-            meta = Meta()
+        # With a cache the rows are also collected, to be stored if
+        # the whole result gets read.
+        results = None
+        if self.cache is not None:
+            results = list()
+            generation = self.cache.generation
 
-            for key, values in zip(keys, result):
-                if not values:
-                    continue
-                meta[key].update(values)
+        rows = self._retry(self._stream, "GetMeta", value, keysOnly)
 
-            pages[page] = meta
+        try:
+            keys = next(rows, None)
+            if results is not None:
+                results.append(keys)
+
+            for row in rows:
+                if results is not None:
+                    results.append(row)
+                yield _rowMeta(keys, row)
+        except xmlrpclib.Fault, fault:
+            raise WikiFault(fault)
 
-        return pages
+        if results:
+            self.cache.put("getMeta", key, results, None, generation)
 
     def setMeta(self, page, meta, replace=False, template=""):
-        if replace:
-            metaMode, categoryMode = "repl", "set"
+        args = _setMetaArgs(page, meta, replace, template)
+        try:
+            return self.request("SetMeta", *args)
+        finally:
+            self._invalidate(page)
+
+    def incSetMeta(self, cleared, discarded, added, maxPages=None,
+                   maxBytes=None, workers=1, retries=3, backoff=1.0):
+        """
+        Clear, discard and add meta values. By default everything is
+        sent in one call, and its result is returned.
+
+        Given maxPages or maxBytes, the changes are split by page into
+        batches of at most maxPages pages and (unless a single page
+        is larger) maxBytes of marshalled data. The batches are sent
+        by the given number of worker threads, and a failed batch is
+        retried up to retries times, waiting backoff seconds before
+        the first retry and twice as long before each following one.
+        Returns an IncSetMetaResult.
+        """
+        args = _incSetMetaArgs(cleared, discarded, added)
+        pages = _incSetMetaPages(*args)
+
+        try:
+            if maxPages is None and maxBytes is None:
+                return self.request("IncSetMeta", *args)
+
+            batches = self._splitIncSetMeta(args, maxPages, maxBytes)
+            return self._sendIncSetMeta(batches, workers, retries, backoff)
+        finally:
+            self._invalidate(*pages)
+
+    def _splitIncSetMeta(self, args, maxPages, maxBytes):
+        batches = list()
+        batch = None
+        batchSize = 0
+
+        for page in sorted(_incSetMetaPages(*args)):
+            parts = [changes[page] for changes in args if page in changes]
+            size = len(self.codec.marshal([page] + parts))
+
+            if batch is not None:
+                if maxPages is not None and len(batch[0]) >= maxPages:
+                    batch = None
+                elif maxBytes is not None and batchSize + size > maxBytes:
+                    batch = None
+
+            if batch is None:
+                batch = set(), dict(), dict(), dict()
+                batchSize = 0
+                batches.append(batch)
+
+            batch[0].add(page)
+            for changes, batchChanges in zip(args, batch[1:]):
+                if page in changes:
+                    batchChanges[page] = changes[page]
+            batchSize += size
+
+        return batches
+
+    def _sendIncSetMeta(self, batches, workers, retries, backoff):
+        result = IncSetMetaResult()
+        result.batches = len(batches)
+        lock = threading.Lock()
+
+        def send(batch):
+            pages, args = batch[0], batch[1:]
+            for attempt in itertools.count():
+                try:
+                    return pages, self.request("IncSetMeta", *args), None
+                except AuthenticationFailed:
+                    raise
+                except (WikiFailure, socket.error, httplib.HTTPException), error:
+                    if attempt >= retries:
+                        return pages, None, error
+
+                with lock:
+                    result.retries += 1
+                delay = backoff * 2 ** attempt
+                time.sleep(random.uniform(0.5, 1.0) * delay)
+
+        if workers > 1 and len(batches) > 1:
+            with self.executor(workers) as executor:
+                sent = list(executor.map(send, batches))
         else:
-            metaMode, categoryMode = "add", "add"
+            sent = map(send, batches)
 
-        keys = dict()
-        for key, values in meta.iteritems():
-            keys[key] = list(values)
+        for pages, value, error in sent:
+            if error is None:
+                result.results.append(value)
+            else:
+                for page in pages:
+                    result.failed[page] = error
+        return result
 
-        # If no categories specified, do not set categories to empty
-        if 'category' not in keys:
-            categoryMode = 'add'
 
-        categories = keys.pop("category", list())
+class GraphingBatch(Batch):
+    # Batched counterparts of the GraphingWiki calls. Each method
+    # queues the call and returns its index in self.results. Cached
+    # entries of the changed pages are invalidated once the calls
+    # have been sent.
 
-        return self.request("SetMeta", page, keys, metaMode,
-                            True, categoryMode, categories,
-                            template)
+    def __init__(self, wiki, **keys):
+        Batch.__init__(self, wiki, **keys)
+        self._changed = set()
 
-    def incSetMeta(self, cleared, discarded, added):
-        clearedDict = dict()
-        for page, keys in cleared.iteritems():
-            clearedDict[page] = list(keys)
+    def flush(self):
+        try:
+            return Batch.flush(self)
+        finally:
+            changed = self._changed
+            self._changed = set()
+            self.wiki._invalidate(*changed)
 
-        discardedDict = dict()
-        for page, meta in discarded.iteritems():
-            discardedDict[page] = dict()
-            for key, values in meta.iteritems():
-                discardedDict[page][key] = list(values)
+    def getPage(self, page):
+        return self.request("getPage", page)
 
-        addedDict = dict()
-        for page, meta in added.iteritems():
-            addedDict[page] = dict()
-            for key, values in meta.iteritems():
-                addedDict[page][key] = list(values)
+    def getPageHTML(self, page):
+        return self.request("getPageHTML", page)
 
-        return self.request("IncSetMeta", clearedDict, discardedDict, addedDict)
+    def _change(self, index, *pages):
+        # Called after queuing, as queuing may flush the earlier calls.
+        self._changed.update(pages)
+        return index
+
+    def putPage(self, page, content):
+        index = self.request("putPage", page, content)
+        return self._change(index, page)
+
+    def deletePage(self, page, comment=None):
+        index = self.request("DeletePage", page, comment)
+        return self._change(index, page)
+
+    def getAttachmentInfo(self, page, filename):
+        return self.request("ChunkedAttachFile", page, filename, "info")
+
+    def getMeta(self, value):
+        keysOnly = False
+        return self._queue("GetMeta", (value, keysOnly), _parseMeta)
+
+    def setMeta(self, page, meta, replace=False, template=""):
+        args = _setMetaArgs(page, meta, replace, template)
+        index = self.request("SetMeta", *args)
+        return self._change(index, page)
+
+    def incSetMeta(self, cleared, discarded, added):
+        args = _incSetMetaArgs(cleared, discarded, added)
+        index = self.request("IncSetMeta", *args)
+        return self._change(index,
+                            *_incSetMetaPages(cleared, discarded, added))
 
 
 def redirected(func, *args, **keys):
@@ -389,10 +1295,10 @@ class CLIWiki(GraphingWiki):
             password = redirected(getpass.getpass, "Password: ")
         return super(CLIWiki, self).authenticate(username, password)
 
-    def request(self, name, *args):
+    def _retry(self, func, *args):
         while True:
             try:
-                return super(CLIWiki, self).request(name, *args)
+                return super(CLIWiki, self)._retry(func, *args)
             except AuthenticationFailed, f:
                 while True:
                     print >> sys.stderr, "Connection Error: " +\